@@ -1,14 +1,17 @@
+import os
 import streamlit as st
-import numpy as np
 from SimulationConfig import SimulationConfig
 from simulation import Simulation
+from simulation_cache import SimulationCache
+from result_store import ResultStore
 from visualizer import Visualizer
 
-# Set random seeds for reproducibility
-def set_random_seeds(seed=42):
-    np.random.seed(seed)
-    import random
-    random.seed(seed)
+# Number of simulation runs kept in memory and shared by all sessions
+SIMULATION_CACHE_SIZE = int(os.environ.get('CH_SIMULATION_CACHE_SIZE', 16))
+
+@st.cache_resource
+def get_simulation_cache():
+    return SimulationCache(SIMULATION_CACHE_SIZE, store=ResultStore())
 
 # Sidebar inputs for simulation parameters
 def create_sidebar_inputs():
@@ -27,6 +30,12 @@ def create_sidebar_inputs():
                                                         0.01, 0.1, 0.02, 
                                                         format="%.2f%%")
 
+    # Seed for reproducibility: the same parameters and seed always give the same results
+    seed = st.sidebar.number_input("Random seed", min_value=0, value=42, step=1)
+
+    # Prevalence and the chronic/treated shares only scale the per-capita results of each group
+    rescale_population = st.sidebar.checkbox("Rescale instead of re-simulating for new prevalence or shares", value=True)
+
     theme = st.get_option('theme.base')
 
     return SimulationConfig(
@@ -36,9 +45,19 @@ def create_sidebar_inputs():
         prop_treated=prop_treated,
         prop_untreated=1 - prop_treated,
         percent_of_patients_to_simulate=percent_of_patients_to_simulate,
+        seed=int(seed),
+        rescale_population=rescale_population,
         theme=theme
     )
 
+# Sidebar inputs for choosing the number of simulated individuals automatically
+def create_adaptive_inputs():
+    with st.sidebar.expander("Automatic Sample Size"):
+        adaptive = st.checkbox("Simulate until the results have converged", value=False)
+        target_relative_error = st.slider("Target standard error (relative to the estimate)", 0.5, 5.0, 1.0, 0.5, format="%.1f%%") / 100
+        time_budget = st.number_input("Time budget (seconds)", min_value=1, value=60, step=10)
+    return (target_relative_error, time_budget) if adaptive else None
+
 # Sidebar inputs for intensity scale transformation parameters
 def create_intensity_scale_inputs(config):
     with st.sidebar.expander("Intensity Scale Transformation"):
@@ -94,8 +113,6 @@ def create_ms_inputs(config):
 def main():
     st.title("Global Burden of Cluster Headache Pain")
 
-    # set_random_seeds()
-
     # Sidebar: configure simulation parameters
     config = create_sidebar_inputs()
     
@@ -107,12 +124,20 @@ def main():
 
     simulation.calculate_ch_groups()
 
-    # Display simulated patients info
-    total_simulated, group_info = simulation.get_simulated_patients_info()
-    st.sidebar.write(f"Total individuals to simulate: {total_simulated:,}, of which:")
-    for group, count, percentage in group_info:
-        st.sidebar.write(f"- {group}: {count:,} ({percentage}%)")
-
+    # Display simulated patients info, above the adaptive inputs it depends on
+    patients_info = st.sidebar.container()
+    adaptive = create_adaptive_inputs()
+    if adaptive is not None:
+        patients_info.write("Individuals to simulate: chosen automatically")
+    else:
+        # With rescaling, the run simulates the default population mix and is rescaled to the chosen one
+        base_run = Simulation(config.base_config())
+        base_run.calculate_ch_groups()
+        total_simulated, group_info = base_run.get_simulated_patients_info()
+        rescaled = " (default population mix, rescaled)" if config.rescale_population else ""
+        patients_info.write(f"Total individuals to simulate{rescaled}: {total_simulated:,}, of which:")
+        for group, count, percentage in group_info:
+            patients_info.write(f"- {group}: {count:,} ({percentage}%)")
     run_simulation = st.sidebar.button("Run Simulation")
 
     # Intensity Scale Transformation inputs
@@ -121,8 +146,15 @@ def main():
 
     if run_simulation:
         with st.spinner("Running simulation..."):
-            simulation = Simulation(config)
-            simulation.run()
+            if adaptive is not None:
+                # The converged run is stored under its final percentage of individuals simulated
+                target_relative_error, time_budget = adaptive
+                simulation = Simulation(config)
+                simulation.run_adaptive(target_relative_error, time_budget)
+                get_simulation_cache().store.save(simulation)
+            else:
+                # Runs already done for the same parameters and seed, in any session or stored on disk, are reused
+                simulation = get_simulation_cache().get(config)
             st.session_state.simulation = simulation
             st.session_state.simulation_run = True
 
@@ -154,6 +186,11 @@ def main():
         st.plotly_chart(fig_comparison)
         fig_exports_all['fig_comparison'] = fig_comparison
 
+        if simulation.convergence_trace:
+            fig_convergence = visualizer.create_convergence_plot()
+            st.plotly_chart(fig_convergence)
+            fig_exports_all['fig_convergence'] = fig_convergence
+
         simulation.update_transformation_params(config.transformation_method, 
                                                 config.transformation_display,
                                                 config.power,
@@ -1,6 +1,19 @@
 from dataclasses import dataclass
+from typing import Optional
+import copy
+import hashlib
+import json
 import numpy as np
 import toml
+from functools import lru_cache
+
+
+@lru_cache(maxsize=None)
+def load_theme(path='.streamlit/config.toml'):
+    # Read once per process: configs are created per scenario and per worker
+    with open(path, 'r') as f:
+        return toml.load(f)['theme']['base']
+
 
 @dataclass
 class SimulationConfig:
@@ -11,6 +24,22 @@ class SimulationConfig:
     prop_treated: float = 0.43
     prop_untreated: float = 1 - prop_treated
     percent_of_patients_to_simulate: float = 0.02
+    intensity_scale_factor: float = 0.9
+    # Overrides of fields of stats_utils.AttackParameters, e.g. {'chronic_treated_mu': 1.0}
+    attack_params: Optional[dict] = None
+    common_random_numbers: bool = False
+    # Variance reduction: stratified patient profiles and antithetic attack draws (see PatientCohort)
+    stratified_profiles: bool = False
+    antithetic_attacks: bool = False
+    # Share of attacks importance sampled at max pain intensities of 9/10 and above (see PatientCohort)
+    importance_tail_share: Optional[float] = None
+    seed: Optional[int] = None
+    n_workers: int = 1
+    shard_size: int = 500
+    streaming: bool = False
+    keep_patient_summaries: bool = True
+    rescale_population: bool = False
+    reweight_intensity_scale: bool = False
     transformation_method: str = 'linear'
     transformation_display: str = 'Linear'
     max_value: int = 1
@@ -24,7 +53,37 @@ class SimulationConfig:
     ms_prevalence_per_100k: int = 37
     ms_fraction_of_year_in_pain: float = .25
     theme: str = 'dark'
+
+    # Fields that determine the simulated results; n_workers and streaming do not change them,
+    # and the transformation and MS fields are applied after the run
+    simulation_fields = ('world_adult_population', 'annual_prevalence_per_100k', 'prop_chronic', 'prop_episodic',
+                         'prop_treated', 'prop_untreated', 'percent_of_patients_to_simulate', 'intensity_scale_factor',
+                         'attack_params', 'common_random_numbers', 'stratified_profiles', 'antithetic_attacks',
+                         'importance_tail_share', 'seed', 'shard_size', 'keep_patient_summaries')
+    # Fields added since results were first stored are only hashed when set, so existing hashes stay valid
+    optional_simulation_fields = {'attack_params': None, 'common_random_numbers': False, 'stratified_profiles': False,
+                                  'antithetic_attacks': False, 'importance_tail_share': None}
+    # Fields that only scale the per-capita results of each group (see rescale_population)
+    population_fields = ('annual_prevalence_per_100k', 'prop_chronic', 'prop_episodic', 'prop_treated', 'prop_untreated')
+
     def __post_init__(self):
-        with open('.streamlit/config.toml', 'r') as f:
-            config = toml.load(f)
-            self.theme = config['theme']['base']
\ No newline at end of file
+        self.theme = load_theme()
+
+    def simulation_hash(self):
+        # Stable across processes and sessions, unlike hash()
+        fields = {name: getattr(self, name) for name in self.simulation_fields
+                  if self.optional_simulation_fields.get(name, object()) != getattr(self, name)}
+        return hashlib.sha256(json.dumps(fields, sort_keys=True).encode()).hexdigest()
+
+    def base_config(self):
+        # The config simulated for this one: with rescale_population its run uses the default population mix
+        # and is rescaled, and with reweight_intensity_scale it uses the default intensity scale factor and is reweighted
+        config = copy.copy(self)
+        if self.rescale_population:
+            for name in self.population_fields:
+                setattr(config, name, getattr(SimulationConfig, name))
+        if self.reweight_intensity_scale:
+            config.intensity_scale_factor = SimulationConfig.intensity_scale_factor
+        config.rescale_population = False
+        config.reweight_intensity_scale = False
+        return config
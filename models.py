@@ -1,111 +1,351 @@
-from dataclasses import dataclass
 import numpy as np
-from scipy.stats import lognorm
+import stats_utils
 from stats_utils import (
-    generate_bouts_per_year, 
+    sample_bouts_per_year, 
     generate_chronic_active_days, 
     generate_attacks_per_day, 
     generate_attack_duration, 
-    generate_max_pain_intensity,
-    optimal_sigma, optimal_mu
+    generate_max_pain_intensity_bins,
+    get_bout_duration_parameters,
+    get_max_pain_intensity_importance_weights,
+    effective_sample_fraction,
+    PatientStreams,
+    StratifiedUniforms,
+    AntitheticUniforms
 )
 
+# Bump whenever a change to the models alters the simulated results or their stored arrays, so stored results are not reused
+MODEL_VERSION = 7
 
-@dataclass
-class Attack:
-    total_duration: int
-    max_intensity: float
-    max_intensity_duration: int
-    onset_duration_fraction: float = 0.15
-    offset_duration_fraction: float = 0.15
-    max_intensity_duration_fraction: float = 1-onset_duration_fraction-offset_duration_fraction
 
-class Patient:
-    def __init__(self, is_chronic, is_treated):
+def generate_cohort_bout_durations(annual_bouts, rng=None):
+    """
+    Bout durations of many patients with one lognormal draw: each patient has
+    ceil(annual_bouts) bouts, the last one shortened by the fractional part
+    of annual_bouts. Returns the flat bout durations (days) and ragged
+    offsets: patient i owns durations[offsets[i]:offsets[i+1]].
+    """
+    n_bouts = np.ceil(annual_bouts).astype(int)
+    offsets = np.concatenate([[0], np.cumsum(n_bouts)])
+    optimal_mu, optimal_sigma = get_bout_duration_parameters()
+    durations = (rng if rng is not None else np.random).lognormal(optimal_mu, optimal_sigma, offsets[-1])
+
+    # Adjust the last bout duration of each patient whose annual_bouts is not an integer
+    fraction = annual_bouts - np.floor(annual_bouts)
+    partial = fraction != 0
+    durations[offsets[1:][partial] - 1] *= fraction[partial]
+
+    # Convert weeks to days, ensure at least 1 day
+    return np.maximum(1, (durations * 7).astype(int)), offsets
+
+
+# Assuming onset and offset phases take up 15% of the total attack duration each
+MAX_INTENSITY_DURATION_FRACTION = 1 - 0.15 - 0.15
+
+# Attacks are sampled in blocks of this size to bound peak memory
+ATTACK_BLOCK_SIZE = 1 << 16
+
+
+def patient_ranks(counts):
+    # Index of each value among its patient's values, for values ordered by patient
+    counts = np.asarray(counts, dtype=np.int64)
+    return np.arange(counts.sum()) - np.repeat(np.cumsum(counts) - counts, counts)
+
+
+class PatientCohort:
+    # Columnar patients of one chronic/treated group, drawn in batches from `rng` (a Generator or PatientStreams);
+    # `stratified`, `antithetic` and `tail_share` select the variance-reduction modes (see README)
+    def __init__(self, is_chronic, is_treated, n_patients, rng=None, intensity_scale_factor=None, attack_params=None,
+                 stratified=False, antithetic=False, tail_share=None):
         self.is_chronic = is_chronic
         self.is_treated = is_treated
-        self.attacks = []
-        self.generate_profile()
-        self.pre_generate_attack_pool()
+        self.n_patients = n_patients
+        self.rng = rng
+        # Resolved once, so that the sampler and the importance weights use the same factor
+        self.intensity_scale_factor = (intensity_scale_factor if intensity_scale_factor is not None
+                                       else stats_utils.INTENSITY_SCALE_FACTOR)
+        self.attack_params = attack_params
+        self.stratified = stratified
+        self.antithetic = antithetic
+        self.tail_share = tail_share
+        self.intensity_weights = None
+        if tail_share is not None:
+            self.intensity_weights = get_max_pain_intensity_importance_weights(
+                is_treated, tail_share, intensity_scale_factor=self.intensity_scale_factor)[1]
+        self.generate_profiles()
+        self.attacks_per_patient = np.zeros(n_patients, dtype=int)
+        self.attack_patient = np.array([], dtype=np.int32)
+        self.attack_total_duration = np.array([], dtype=np.int16)
+        self.attack_intensity_bin = np.array([], dtype=np.uint8)
+        self.attack_max_intensity_duration = np.array([], dtype=np.int16)
 
-    def generate_profile(self):
-        if self.is_chronic:
-            self.active_days = generate_chronic_active_days()
-        else:
-            self.annual_bouts = generate_bouts_per_year().rvs()
-            self.bout_durations = self.generate_bout_durations()
+    @property
+    def attack_max_intensity(self):
+        return self.attack_intensity_bin * 0.1
+
+    def stream(self, quantity, counts=None):
+        # Random source of a batched draw of counts[i] values (default 1) for each patient i
+        if not isinstance(self.rng, PatientStreams):
+            return self.rng
+        if counts is None:
+            return self.rng.select(quantity, np.arange(self.n_patients))
+        return self.rng.select(quantity, np.repeat(np.arange(self.n_patients), counts), patient_ranks(counts))
 
-    def pre_generate_attack_pool(self):
-        # Estimate the maximum number of attacks in a year
+    def profile_stream(self, quantity):
+        # Random source of a per-patient profile draw, stratified over the cohort when requested
+        rng = self.stream(quantity)
+        return StratifiedUniforms(rng) if self.stratified else rng
+
+    def generate_profiles(self):
+        # One batched draw per distribution for the whole cohort
         if self.is_chronic:
-            max_attacks = self.active_days * 8  # Assuming max 8 attacks per day
+            self.active_days = np.minimum(365, generate_chronic_active_days(self.profile_stream('active_days'), size=self.n_patients))
+            self.annual_bouts = None
+            self.bout_durations = None
+            self.bout_offsets = None
         else:
-            max_attacks = sum(self.bout_durations) * 8
-
-        # Generate a pool of attacks
-        max_intensities = generate_max_pain_intensity(is_treated=self.is_treated, size=max_attacks)
-        total_durations = generate_attack_duration(self.is_chronic, self.is_treated, max_intensities, size=max_attacks)
-        # Assuming onset and offset phases take up 15% of the total attack duration each
-        max_intensity_durations = np.round(Attack.max_intensity_duration_fraction * total_durations).astype(int)
-
-        self.attack_pool = [Attack(total_durations[i], max_intensities[i], max_intensity_durations[i])
-                            for i in range(max_attacks)]
-        self.pool_index = 0
-        
-    def generate_bout_durations(self):
-        # Use the lognormal distribution for bout durations
-        n_bouts = np.ceil(self.annual_bouts)
-        durations = lognorm.rvs(s=optimal_sigma, scale=np.exp(optimal_mu), size=int(n_bouts))
-        
-        # Adjust the last bout duration if annual_bouts is not an integer
-        if self.annual_bouts != int(self.annual_bouts):
-            durations[-1] *= (self.annual_bouts - int(self.annual_bouts))
-        
-        return [max(1, int(duration * 7)) for duration in durations]  # Convert weeks to days, ensure at least 1 day
+            self.annual_bouts = sample_bouts_per_year(self.n_patients, self.profile_stream('annual_bouts'))
+            self.bout_durations, self.bout_offsets = generate_cohort_bout_durations(
+                self.annual_bouts, self.stream('bout_durations', np.ceil(self.annual_bouts).astype(int)))
+            self.active_days = np.add.reduceat(self.bout_durations, self.bout_offsets[:-1]) if self.n_patients else np.array([], dtype=int)
 
     def generate_year_of_attacks(self):
-        self.attacks = []
-        total_attacks = 0
+        day_rng = self.stream('attacks_per_day', self.active_days)
+        if self.antithetic:
+            day_rng = AntitheticUniforms(day_rng, patient_ranks(self.active_days) % 2 == 1)
+        attacks_per_day = generate_attacks_per_day(self.is_chronic, self.is_treated, size=int(self.active_days.sum()),
+                                                   rng=day_rng, attack_params=self.attack_params)
+        if self.n_patients:
+            # Every patient has at least one active day, so the day offsets split attacks_per_day cleanly
+            day_offsets = np.concatenate([[0], np.cumsum(self.active_days)[:-1]])
+            self.attacks_per_patient = np.add.reduceat(attacks_per_day, day_offsets)
+        del attacks_per_day
+        total_attacks = int(self.attacks_per_patient.sum())
 
-        if self.is_chronic:
-            active_days = min(365, self.active_days)
-            attacks_per_day = generate_attacks_per_day(self.is_chronic, self.is_treated, size=active_days)
+        # Exactly as many attacks as the daily counts add up to, sampled in fixed-size blocks so
+        # the float temporaries of the samplers stay bounded; durations fit in int16 (15-360 minutes)
+        self.attack_patient = np.repeat(np.arange(self.n_patients, dtype=np.int32), self.attacks_per_patient)
+        self.attack_intensity_bin = np.empty(total_attacks, dtype=np.uint8)
+        self.attack_total_duration = np.empty(total_attacks, dtype=np.int16)
+        patient_streams = isinstance(self.rng, PatientStreams)
+        if patient_streams or self.antithetic:
+            attack_ranks = patient_ranks(self.attacks_per_patient)
+        intensity_rng = duration_rng = self.rng
+        for start in range(0, total_attacks, ATTACK_BLOCK_SIZE):
+            block = slice(start, min(start + ATTACK_BLOCK_SIZE, total_attacks))
+            block_size = block.stop - block.start
+            if patient_streams:
+                intensity_rng = self.rng.select('intensity', self.attack_patient[block], attack_ranks[block])
+                duration_rng = self.rng.select('attack_duration', self.attack_patient[block], attack_ranks[block])
+            if self.antithetic:
+                # A pair split by the block boundary is drawn independently
+                paired = attack_ranks[block] % 2 == 1
+                paired[0] = False
+                duration_rng = AntitheticUniforms(duration_rng if patient_streams else self.rng, paired)
+            intensity_bins = generate_max_pain_intensity_bins(is_treated=self.is_treated, size=block_size, rng=intensity_rng,
+                                                              intensity_scale_factor=self.intensity_scale_factor,
+                                                              tail_share=self.tail_share)
+            self.attack_intensity_bin[block] = intensity_bins
+            self.attack_total_duration[block] = generate_attack_duration(self.is_chronic, self.is_treated, intensity_bins * 0.1, size=block_size, rng=duration_rng)
+        self.attack_max_intensity_duration = np.round(MAX_INTENSITY_DURATION_FRACTION * self.attack_total_duration).astype(np.int16)
+        return total_attacks
+
+    def calculate_summary(self, n_bins=101):
+        """
+        Aggregate all attacks with one weighted bincount over (patient, bin).
+        Returns the patients x intensity-bins matrix of minutes at max
+        intensity, plus per-patient total attacks, total attack duration and
+        average max intensity, the number of attacks in each bin and the
+        weight of the attacks in each bin. Minutes and durations are weighted
+        by the importance weights of the attacks' bins, and the average
+        intensity is the weighted average.
+        """
+        attack_weights = np.ones(n_bins) if self.intensity_weights is None else self.intensity_weights
+        minutes = self.attack_max_intensity_duration
+        durations = self.attack_total_duration
+        if self.intensity_weights is not None:
+            weights = self.intensity_weights[self.attack_intensity_bin]
+            minutes = minutes * weights
+            durations = durations * weights
+        flat_index = self.attack_patient.astype(np.int64)
+        flat_index *= n_bins
+        flat_index += self.attack_intensity_bin
+        intensity_minutes = np.bincount(flat_index, weights=minutes,
+                                        minlength=self.n_patients * n_bins).reshape(self.n_patients, n_bins)
+        del flat_index, minutes
+
+        total_duration = np.bincount(self.attack_patient, weights=durations, minlength=self.n_patients)
+        if self.intensity_weights is None:
+            intensity_bin_sums = np.bincount(self.attack_patient, weights=self.attack_intensity_bin, minlength=self.n_patients)
+            attack_weight_sums = self.attacks_per_patient
         else:
-            active_days = sum(self.bout_durations)
-            attacks_per_day = generate_attacks_per_day(self.is_chronic, self.is_treated, size=active_days)
+            intensity_bin_sums = np.bincount(self.attack_patient, weights=self.attack_intensity_bin * weights, minlength=self.n_patients)
+            attack_weight_sums = np.bincount(self.attack_patient, weights=weights, minlength=self.n_patients)
+        average_intensity = np.divide(intensity_bin_sums * 0.1, attack_weight_sums,
+                                      out=np.zeros(self.n_patients), where=attack_weight_sums > 0)
+        attack_counts = np.bincount(self.attack_intensity_bin, minlength=n_bins)
+        return intensity_minutes, self.attacks_per_patient, total_duration, average_intensity, attack_counts, attack_weights
 
-        total_attacks = self.generate_day_attacks(attacks_per_day)
-        return total_attacks
 
-    def generate_day_attacks(self, attacks_per_day):
-        daily_attacks = 0
-
-        if self.pool_index + sum(attacks_per_day) > len(self.attack_pool):
-            # If we've used all pre-generated attacks, generate more
-            self.pre_generate_attack_pool()
-        
-        for attacks_today in attacks_per_day:
-            day_attacks = self.attack_pool[self.pool_index:self.pool_index + attacks_today]
-            self.attacks.extend(day_attacks)
-            self.pool_index += attacks_today
-            daily_attacks += attacks_today
-
-        return daily_attacks
-
-    def calculate_intensity_minutes(self):
-        intensity_minutes = {}
-        for attack in self.attacks:
-            intensity = attack.max_intensity
-            intensity_minutes[intensity] = intensity_minutes.get(intensity, 0) + attack.max_intensity_duration
-        return intensity_minutes
-
-    def calculate_total_attacks(self):
-        return len(self.attacks)
-
-    def calculate_total_duration(self):
-        return sum(attack.total_duration for attack in self.attacks)
-
-    def calculate_average_intensity(self):
-        if not self.attacks:
-            return 0
-        return np.mean([attack.max_intensity for attack in self.attacks])
\ No newline at end of file
+class GroupAccumulator:
+    # Mergeable per-bin statistics of one group's patients (Welford moments, co-moments, weighted attack counts);
+    # `stratified` also keeps the co-moments of neighbour differences, for collapsed-strata standard errors
+    def __init__(self, n_bins=101, keep_patient_summaries=True, stratified=False):
+        self.n_bins = n_bins
+        self.stratified = stratified
+        self.n_patients = 0
+        self.minutes_total = np.zeros(n_bins)
+        self.count = np.zeros(n_bins, dtype=np.int64)
+        self.mean = np.zeros(n_bins)
+        self.m2 = np.zeros(n_bins)
+        self.cov_m2 = np.zeros((n_bins, n_bins))
+        self.strata_m2 = np.zeros((n_bins, n_bins))
+        self.attack_counts = np.zeros(n_bins, dtype=np.int64)
+        self.attack_weights = np.ones(n_bins)
+        self.keep_patient_summaries = keep_patient_summaries
+        self.total_attacks = []
+        self.total_durations = []
+        self.average_intensities = []
+        self.tail_minutes = []
+
+    @classmethod
+    def from_summary(cls, summary, keep_patient_summaries=True, stratified=False):
+        intensity_minutes, total_attacks, total_durations, average_intensities, attack_counts, attack_weights = summary
+        accumulator = cls(intensity_minutes.shape[1], keep_patient_summaries, stratified)
+        accumulator.n_patients = len(intensity_minutes)
+        accumulator.minutes_total = intensity_minutes.sum(axis=0)
+        has_minutes = intensity_minutes > 0
+        accumulator.count = has_minutes.sum(axis=0)
+        accumulator.mean = np.divide(accumulator.minutes_total, accumulator.count,
+                                     out=np.zeros(accumulator.n_bins), where=accumulator.count > 0)
+        accumulator.m2 = np.where(has_minutes, (intensity_minutes - accumulator.mean) ** 2, 0).sum(axis=0)
+        centered = intensity_minutes - accumulator.average()
+        accumulator.cov_m2 = centered.T @ centered
+        if stratified and accumulator.n_patients >= 2:
+            # Each pair's squared difference estimates the variance of its two strata; an odd
+            # patient out is covered by scaling up the pairs
+            n_pairs = accumulator.n_patients // 2
+            differences = intensity_minutes[0:2 * n_pairs:2] - intensity_minutes[1:2 * n_pairs:2]
+            accumulator.strata_m2 = differences.T @ differences * (accumulator.n_patients / (2 * n_pairs))
+        accumulator.attack_counts = np.asarray(attack_counts, dtype=np.int64)
+        accumulator.attack_weights = np.asarray(attack_weights, dtype=float)
+        if keep_patient_summaries:
+            # Compact per-patient summaries (56 bytes per patient) for the patient-level plots and paired comparisons
+            accumulator.total_attacks.append(np.asarray(total_attacks, dtype=np.int32))
+            accumulator.total_durations.append(np.asarray(total_durations, dtype=np.int32))
+            accumulator.average_intensities.append(np.asarray(average_intensities, dtype=np.float32))
+            whole_intensities = slice(None, None, (accumulator.n_bins - 1) // 10)
+            accumulator.tail_minutes.append(tail_sums(intensity_minutes)[:, whole_intensities].astype(np.float32))
+        return accumulator
+
+    def merge(self, other):
+        # Chan et al. pairwise update of the per-bin moments
+        count = self.count + other.count
+        delta = other.mean - self.mean
+        other_weight = np.divide(other.count, count, out=np.zeros(self.n_bins), where=count > 0)
+        self.mean = self.mean + delta * other_weight
+        self.m2 = self.m2 + other.m2 + delta ** 2 * self.count * other_weight
+        self.count = count
+
+        n_patients = self.n_patients + other.n_patients
+        if n_patients:
+            delta = other.average() - self.average()
+            self.cov_m2 = self.cov_m2 + other.cov_m2 + np.outer(delta, delta) * self.n_patients * other.n_patients / n_patients
+        self.n_patients = n_patients
+        self.strata_m2 = self.strata_m2 + other.strata_m2
+        self.minutes_total = self.minutes_total + other.minutes_total
+        self.attack_counts = self.attack_counts + other.attack_counts
+        # The attacks of a group all share the same weights
+        self.attack_weights = other.attack_weights
+        if self.keep_patient_summaries:
+            self.total_attacks.extend(other.total_attacks)
+            self.total_durations.extend(other.total_durations)
+            self.average_intensities.extend(other.average_intensities)
+            self.tail_minutes.extend(other.tail_minutes)
+        return self
+
+    def average(self):
+        if self.n_patients == 0:
+            return np.zeros(self.n_bins)
+        return self.minutes_total / self.n_patients
+
+    def std(self):
+        # The spread at each intensity is taken over the patients that experienced it
+        return np.sqrt(np.divide(self.m2, self.count, out=np.zeros(self.n_bins), where=self.count > 0))
+
+    def tail_average(self):
+        # Mean minutes per patient at or above each intensity
+        return tail_sums(self.average())
+
+    def tail_standard_error(self):
+        # Standard error of tail_average, from the co-moments of the bins at or above each intensity
+        if self.n_patients < 2:
+            return np.zeros(self.n_bins)
+        if self.stratified:
+            tail_m2 = np.diagonal(tail_sums(tail_sums(self.strata_m2, axis=0), axis=1))
+            return np.sqrt(np.maximum(tail_m2, 0)) / self.n_patients
+        tail_m2 = np.diagonal(tail_sums(tail_sums(self.cov_m2, axis=0), axis=1))
+        return np.sqrt(np.maximum(tail_m2, 0) / (self.n_patients - 1) / self.n_patients)
+
+    def reweighted(self, weights):
+        """
+        Statistics of the same patients with their minutes at each intensity
+        bin scaled by `weights`. Per-patient summaries are not carried over,
+        as they cannot be reweighted by bin.
+        """
+        accumulator = GroupAccumulator(self.n_bins, keep_patient_summaries=False, stratified=self.stratified)
+        accumulator.n_patients = self.n_patients
+        accumulator.minutes_total = self.minutes_total * weights
+        accumulator.count = np.where(weights > 0, self.count, 0)
+        accumulator.mean = self.mean * weights
+        accumulator.m2 = self.m2 * weights ** 2
+        accumulator.cov_m2 = self.cov_m2 * np.outer(weights, weights)
+        accumulator.strata_m2 = self.strata_m2 * np.outer(weights, weights)
+        accumulator.attack_counts = self.attack_counts
+        accumulator.attack_weights = self.attack_weights * weights
+        return accumulator
+
+    def effective_sample_fraction(self):
+        # Kish effective sample fraction of the weighted attacks
+        return effective_sample_fraction(self.attack_counts, self.attack_weights)
+
+    def patient_summaries(self):
+        return (np.concatenate(self.total_attacks or [np.array([], dtype=np.int32)]),
+                np.concatenate(self.total_durations or [np.array([], dtype=np.int32)]),
+                np.concatenate(self.average_intensities or [np.array([], dtype=np.float32)]),
+                np.concatenate(self.tail_minutes or [np.zeros((0, 11), dtype=np.float32)]))
+
+
+def tail_sums(values, axis=-1):
+    # Reverse cumulative sums: entry k is the sum of values[k:] along axis
+    return np.flip(np.cumsum(np.flip(values, axis), axis=axis), axis)
+
+
+class BurdenIndex:
+    """
+    Threshold queries over per-intensity results. Each quantity (person-years,
+    their variances, adjusted units, ...) is stored as reverse cumulative sums
+    over the intensity bins, per group and for the total over all groups, so
+    the amount at or above any intensity is a single lookup.
+    """
+    def __init__(self, groups, n_bins=101):
+        self.groups = list(groups)
+        self.n_bins = n_bins
+        self.tails = {}
+
+    def add(self, quantity, series):
+        # series maps every group to its per-bin values
+        tails = tail_sums(np.array([series[group] for group in self.groups], dtype=float))
+        self.tails[quantity] = dict(zip(self.groups, tails))
+        self.tails[quantity]['Total'] = tails.sum(axis=0)
+
+    def copy(self):
+        # Quantities are replaced, never modified, by add, so the tails can be shared
+        index = BurdenIndex(self.groups, self.n_bins)
+        index.tails = dict(self.tails)
+        return index
+
+    def at_least(self, quantity, threshold=0, group='Total'):
+        # Amount of the quantity at intensities >= threshold (0-10 scale; scalar or array)
+        index = np.rint(np.asarray(threshold) * (self.n_bins - 1) / 10).astype(int)
+        return self.tails[quantity][group][index]
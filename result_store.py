@@ -0,0 +1,118 @@
+import os
+import json
+import shutil
+import tempfile
+import hashlib
+import numpy as np
+import stats_utils
+from models import GroupAccumulator, MODEL_VERSION
+from simulation import Simulation
+
+RESULT_STORE_DIR = os.environ.get('CH_RESULT_STORE_DIR', os.path.join(stats_utils.FIT_CACHE_DIR, 'results'))
+
+# Per-group accumulator arrays, stored stacked in the group order of the metadata
+GROUP_ARRAYS = ('minutes_total', 'count', 'mean', 'm2', 'cov_m2', 'strata_m2', 'attack_counts', 'attack_weights')
+PATIENT_ARRAYS = ('total_attacks', 'total_durations', 'average_intensities', 'tail_minutes')
+
+
+class ResultStore:
+    """
+    On-disk store of simulation results, one directory per run addressed by
+    a hash of the simulation config (including the seed) and the model
+    version. A run holds its per-group accumulators
+    and per-patient summaries as .npy files, read back memory-mapped, plus a
+    metadata.json with the config, ch_groups and array layout. Runs without
+    a seed are not reproducible and are never stored.
+    """
+    def __init__(self, root=RESULT_STORE_DIR):
+        self.root = root
+
+    def key(self, config):
+        inputs = [config.simulation_hash(), MODEL_VERSION]
+        return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()[:32]
+
+    def path(self, config):
+        return os.path.join(self.root, self.key(config))
+
+    def load(self, config):
+        # Returns the stored run for config as a Simulation, or None
+        if config.seed is None:
+            return None
+        path = self.path(config)
+        try:
+            with open(os.path.join(path, 'metadata.json')) as f:
+                metadata = json.load(f)
+            arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode='r')
+                      for name in GROUP_ARRAYS + PATIENT_ARRAYS + ('n_patients', 'patient_offsets')}
+        except OSError:
+            return None
+        except ValueError:
+            # A corrupt run is removed, so that the next save stores it again
+            shutil.rmtree(path, ignore_errors=True)
+            return None
+
+        accumulators = {}
+        for i, group in enumerate(metadata['groups']):
+            accumulator = GroupAccumulator(metadata['n_bins'], metadata['keep_patient_summaries'], config.stratified_profiles)
+            accumulator.n_patients = int(arrays['n_patients'][i])
+            for name in GROUP_ARRAYS:
+                setattr(accumulator, name, arrays[name][i])
+            if accumulator.keep_patient_summaries:
+                patients = slice(arrays['patient_offsets'][i], arrays['patient_offsets'][i + 1])
+                for name in PATIENT_ARRAYS:
+                    getattr(accumulator, name).append(arrays[name][patients])
+            accumulators[group] = accumulator
+
+        simulation = Simulation(config)
+        simulation.calculate_ch_groups()
+        simulation.calculate_results(accumulators)
+        return simulation
+
+    def save(self, simulation):
+        # Best effort: a store that cannot be written to only means the run is not kept
+        config = simulation.config
+        if config.seed is None:
+            return
+        path = self.path(config)
+        if os.path.isdir(path):
+            return
+        groups = list(simulation.ch_groups.keys())
+        accumulators = [simulation.accumulators[group] for group in groups]
+        patient_summaries = [accumulator.patient_summaries() for accumulator in accumulators]
+        metadata = {
+            'config': {name: getattr(config, name) for name in config.simulation_fields},
+            'model_version': MODEL_VERSION,
+            'ch_groups': simulation.ch_groups,
+            'groups': groups,
+            'n_bins': len(simulation.intensities),
+            'keep_patient_summaries': config.keep_patient_summaries
+        }
+
+        # Write into a private directory and rename it into place, so readers never see a partial run
+        tmp_path = None
+        try:
+            os.makedirs(self.root, exist_ok=True)
+            tmp_path = tempfile.mkdtemp(prefix=f"{self.key(config)}.", suffix='.tmp', dir=self.root)
+            for name in GROUP_ARRAYS:
+                np.save(os.path.join(tmp_path, f"{name}.npy"), np.array([getattr(a, name) for a in accumulators]))
+            np.save(os.path.join(tmp_path, 'n_patients.npy'), np.array([a.n_patients for a in accumulators], dtype=np.int64))
+            for i, name in enumerate(PATIENT_ARRAYS):
+                np.save(os.path.join(tmp_path, f"{name}.npy"), np.concatenate([summary[i] for summary in patient_summaries]))
+            patient_counts = [len(summary[0]) for summary in patient_summaries]
+            np.save(os.path.join(tmp_path, 'patient_offsets.npy'), np.concatenate([[0], np.cumsum(patient_counts)]).astype(np.int64))
+            with open(os.path.join(tmp_path, 'metadata.json'), 'w') as f:
+                json.dump(metadata, f, indent=1)
+            os.rename(tmp_path, path)
+        except OSError:
+            if tmp_path is not None:
+                shutil.rmtree(tmp_path, ignore_errors=True)
+
+    def get_or_run(self, config):
+        if config.rescale_population or config.reweight_intensity_scale:
+            return self.get_or_run(config.base_config()).adapted(config, run=self.get_or_run)
+        simulation = self.load(config)
+        if simulation is None:
+            simulation = Simulation(config)
+            simulation.run()
+            self.save(simulation)
+        return simulation
@@ -0,0 +1,655 @@
+import os
+import csv
+import json
+import hashlib
+import argparse
+import itertools
+import dataclasses
+import numpy as np
+import pandas as pd
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from typing import Dict, List, Optional
+from SimulationConfig import SimulationConfig
+from simulation import Simulation
+from models import MODEL_VERSION
+from stats_utils import AttackParameters, get_attack_parameters
+from result_store import ResultStore
+
+PARAMETER_NAMES = {
+    'prevalence': 'Prevalence',
+    'treatment_access': 'Treatment access',
+    'chronic_fraction': 'Chronic %',
+    'instensity_scale_factor': 'Intensity scale'
+}
+DEFAULT_PARAMETERS = ['prevalence', 'treatment_access', 'chronic_fraction']
+METRICS = ['dles', 'ylss', 'total_person_years', 'total_ch_sufferers']
+# Differences from the base case, in days, with their paired standard errors
+PAIRED_METRICS = ['dles_change', 'dles_change_se', 'ylss_change', 'ylss_change_se']
+CHECKPOINT_FILE = 'sensitivity_checkpoint.jsonl'
+ATTACK_PARAMETER_NAMES = [field.name for field in dataclasses.fields(AttackParameters)]
+# Relative spread of the attacks-per-day parameters around their fitted values in the global analysis
+ATTACK_PARAMETER_SPREAD = 0.1
+SOBOL_METRICS = ['dles', 'ylss']
+
+
+def scenario_seed(seed, config):
+    """
+    Seed for a scenario, derived from the values of its simulated parameters
+    rather than from its position in the grid, so a scenario gets the same
+    seed in any grid and in any order. Scenarios rescaled or reweighted from
+    the same run share its seed (config should be the base config).
+    """
+    fields = {name: getattr(config, name) for name in config.simulation_fields if name != 'seed'}
+    digest = hashlib.sha256(json.dumps([seed, fields], sort_keys=True).encode()).digest()
+    return int.from_bytes(digest[:4], 'little')
+
+
+def calculate_dles(simulation: Simulation, base: Optional[Simulation] = None) -> Dict[str, float]:
+    """
+    Calculate DLES and other key metrics from simulation results, and with a
+    base case simulation the paired differences of DLES and YLSS from it
+    """
+    index = simulation.burden_index
+
+    # Calculate total person-years at ≥9/10 intensity
+    total_extreme_pain = index.at_least('person_years', 9)
+
+    # Convert to days (DLES)
+    dles = total_extreme_pain * 365
+
+    # Also calculate ≥7/10 intensity (YLSS equivalent)
+    total_severe_pain = index.at_least('person_years', 7)
+    ylss = total_severe_pain * 365
+
+    # Total person-years in any pain
+    total_pain = index.at_least('person_years', 0)
+
+    metrics = {
+        'dles': dles,
+        'ylss': ylss,
+        'total_person_years': total_pain,
+        'total_ch_sufferers': simulation.get_total_ch_sufferers()
+    }
+    if base is not None:
+        for metric, threshold in (('dles', 9), ('ylss', 7)):
+            difference, standard_error = simulation.paired_difference(base, threshold)
+            metrics[f'{metric}_change'] = difference * 365
+            metrics[f'{metric}_change_se'] = standard_error * 365
+    return metrics
+
+
+def sobol_indices(f_a, f_b, f_ab):
+    """
+    First-order (Saltelli 2010) and total (Jansen) Sobol indices from model
+    outputs on the sample matrices A and B, shaped (..., N), and on the
+    matrices AB_i (A with column i taken from B), shaped (..., k, N).
+    Returns two arrays shaped (..., k).
+    """
+    variance = np.var(np.concatenate([f_a, f_b], axis=-1), axis=-1)[..., None]
+    f_a = f_a[..., None, :]
+    first_order = np.mean(f_b[..., None, :] * (f_ab - f_a), axis=-1) / variance
+    total = 0.5 * np.mean((f_a - f_ab) ** 2, axis=-1) / variance
+    return first_order, total
+
+
+def checkpoint_key(config, base_config=None):
+    # Identifies a scenario's results: its parameter values and seed (through the simulation hash),
+    # whether it was rescaled or reweighted, the model version and the base case it is compared with
+    inputs = [config.simulation_hash(), config.rescale_population, config.reweight_intensity_scale, MODEL_VERSION]
+    if base_config is not None:
+        inputs.append(checkpoint_key(base_config))
+    return hashlib.sha256(json.dumps(inputs).encode()).hexdigest()[:32]
+
+
+def load_checkpoint(path):
+    # Metrics of completed scenarios by checkpoint key; a line cut short by a crash is ignored
+    completed = {}
+    try:
+        with open(path) as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                    completed[entry['key']] = entry['metrics']
+                except (ValueError, KeyError):
+                    continue
+    except OSError:
+        pass
+    return completed
+
+
+def open_checkpoint(path):
+    # For appending, starting on a new line if the last one was cut short
+    f = open(path, 'a+')
+    if f.tell() > 0:
+        f.seek(f.tell() - 1)
+        if f.read(1) != '\n':
+            f.write('\n')
+    return f
+
+
+def run_scenarios(configs, result_store, base_config=None):
+    # One task of the process pool: scenarios sharing a base run, which is simulated (or loaded) once
+    base = result_store.get_or_run(base_config) if base_config is not None else None
+    return [calculate_dles(result_store.get_or_run(config), base) for config in configs]
+
+
+class FlexibleSensitivityAnalyzer:
+    def __init__(self, percent_of_patients_to_simulate=0.1, seed=42, rescale=True, n_workers=1, result_store=None,
+                 parameter_ranges=None, common_random_numbers=False):
+        self.base_config = SimulationConfig()
+        self.results = []
+        self.percent_of_patients_to_simulate = percent_of_patients_to_simulate
+        self.seed = seed
+        # Prevalence, the chronic/treated shares and the intensity scale factor are applied by rescaling and
+        # reweighting a single simulation (intensity scale factors that reweight poorly are simulated)
+        self.rescale = rescale
+        self.n_workers = n_workers
+        # Scenarios simulated before with the same parameters and seed are loaded from disk
+        self.result_store = result_store if result_store is not None else ResultStore()
+        # Extra or changed levels, e.g. {'prevalence': {'very_high': 120}}, merged into the default ranges
+        self.parameter_ranges = parameter_ranges or {}
+        # Every scenario simulates each patient slot from the same random streams, so differences between
+        # scenarios are paired patient by patient; intensity scale factors are then simulated, not reweighted
+        self.common_random_numbers = common_random_numbers
+
+    def define_parameter_ranges(self) -> Dict[str, Dict[str, float]]:
+        """Define all available parameter variations to test"""
+        ranges = {
+            'prevalence': {
+                'low': 26,      # per 100,000
+                'base': 53,
+                'high': 95
+            },
+            'treatment_access': {
+                'low': 0.25,
+                'base': 0.43,
+                'high': 0.60
+            },
+            'chronic_fraction': {
+                'low': 0.15,
+                'base': 0.20,
+                'high': 0.25
+            },
+            'instensity_scale_factor': {
+                'low': 0.8,
+                'base': 0.9,
+                'high': 1.0
+            }
+        }
+        for param, levels in self.parameter_ranges.items():
+            ranges[param] = {**ranges.get(param, {}), **levels}
+        return ranges
+
+    def create_config_variant(self, **kwargs) -> SimulationConfig:
+        """Create a configuration with modified parameters"""
+        config = SimulationConfig()
+
+        # Apply parameter changes
+        if 'prevalence' in kwargs:
+            config.annual_prevalence_per_100k = kwargs['prevalence']
+        if 'treatment_access' in kwargs:
+            config.prop_treated = kwargs['treatment_access']
+            config.prop_untreated = 1 - kwargs['treatment_access']
+        if 'chronic_fraction' in kwargs:
+            config.prop_chronic = kwargs['chronic_fraction']
+            config.prop_episodic = 1 - kwargs['chronic_fraction']
+        if 'instensity_scale_factor' in kwargs:
+            config.intensity_scale_factor = kwargs['instensity_scale_factor']
+        attack_params = {name: float(kwargs[name]) for name in ATTACK_PARAMETER_NAMES if name in kwargs}
+        if attack_params:
+            config.attack_params = attack_params
+
+        # Use smaller simulation size for speed
+        config.percent_of_patients_to_simulate = self.percent_of_patients_to_simulate
+        config.rescale_population = self.rescale
+        config.reweight_intensity_scale = self.rescale and not self.common_random_numbers
+        config.common_random_numbers = self.common_random_numbers
+        # Seed every scenario for reproducibility; with common random numbers all share the seed of the base case
+        seed_config = config.base_config()
+        if self.common_random_numbers:
+            seed_config = SimulationConfig(percent_of_patients_to_simulate=self.percent_of_patients_to_simulate,
+                                           common_random_numbers=True)
+        config.seed = scenario_seed(self.seed, seed_config)
+        return config
+
+    def define_global_ranges(self) -> Dict[str, tuple]:
+        """
+        Continuous ranges of the global analysis: from the lowest to the
+        highest level of each factorial parameter, and the fitted
+        attacks-per-day parameters ± ATTACK_PARAMETER_SPREAD
+        """
+        ranges = {param: (min(levels.values()), max(levels.values()))
+                  for param, levels in self.define_parameter_ranges().items()}
+        for name, value in dataclasses.asdict(get_attack_parameters()).items():
+            ranges[name] = (value * (1 - ATTACK_PARAMETER_SPREAD), value * (1 + ATTACK_PARAMETER_SPREAD))
+        return ranges
+
+    def define_scenarios(self, vary_parameters: List[str]) -> List[Dict]:
+        """All combinations of the low/base/high values of the selected parameters"""
+        param_ranges = self.define_parameter_ranges()
+
+        # Filter to only the parameters we want to vary
+        selected_ranges = {param: param_ranges[param] for param in vary_parameters if param in param_ranges}
+
+        if not selected_ranges:
+            raise ValueError(f"No valid parameters selected. Available: {list(param_ranges.keys())}")
+
+        param_names = list(selected_ranges.keys())
+        scenarios = []
+        for i, combination in enumerate(itertools.product(*[selected_ranges[param].items() for param in param_names])):
+            scenario = {'scenario': i + 1}
+            for param_name, (label, value) in zip(param_names, combination):
+                scenario[f'{param_name}_label'] = label
+                scenario[f'{param_name}_value'] = value
+            # Check if this is base case (all parameters at 'base')
+            scenario['is_base_case'] = all(label == 'base' for label, _ in combination)
+            scenarios.append(scenario)
+        return scenarios
+
+    def evaluate(self, scenarios: List[Dict], configs: List[SimulationConfig], output: Optional[str] = None,
+                 checkpoint: Optional[str] = None, describe=None,
+                 base_config: Optional[SimulationConfig] = None) -> List[Dict]:
+        """
+        Metrics of each scenario (a dict of its parameters, numbered by its
+        'scenario' entry) simulated with its config, in scenario order.
+        Scenarios that rescale or reweight the same run form one task, so the
+        run is simulated once, and tasks run on n_workers processes.
+
+        Args:
+            output: CSV file that each scenario's results are written to as soon as they complete
+            checkpoint: JSON lines file of completed scenarios; scenarios found in it are not run again,
+                        and scenarios completed by this run are added to it
+            describe: Function giving the progress description of a scenario; without it progress
+                      is printed every 10% of the scenarios
+            base_config: Config of the base case; scenarios then also get their paired differences from it
+        """
+        completed = load_checkpoint(checkpoint) if checkpoint is not None else {}
+        if base_config is not None:
+            # Simulated (or stored) once up front, so the workers load it instead of all simulating it
+            self.result_store.get_or_run(base_config)
+
+        tasks = {}
+        cached = []
+        for scenario, config in zip(scenarios, configs):
+            scenario['seed'] = config.seed
+            key = checkpoint_key(config, base_config)
+            if key in completed:
+                cached.append((scenario, key))
+                continue
+            task_configs, members = tasks.setdefault(config.base_config().simulation_hash(), ([], []))
+            task_configs.append(config)
+            members.append((scenario, key))
+        if cached:
+            print(f"Skipping {len(cached)} scenarios completed in an earlier run")
+
+        results = []
+        output_file = open(output, 'w', newline='') if output is not None else None
+        checkpoint_file = open_checkpoint(checkpoint) if checkpoint is not None else None
+        try:
+            if output_file is not None:
+                metrics = METRICS + (PAIRED_METRICS if base_config is not None else [])
+                writer = csv.DictWriter(output_file, fieldnames=list(scenarios[0].keys()) + metrics)
+                writer.writeheader()
+
+            def collect(members, metrics):
+                for (scenario, key), scenario_metrics in zip(members, metrics):
+                    result = {**scenario, **scenario_metrics}
+                    results.append(result)
+                    if describe is not None:
+                        print(f"Scenario {len(results)}/{len(scenarios)} (#{result['scenario']}): {describe(result)}")
+                    elif len(results) % max(1, len(scenarios) // 10) == 0 or len(results) == len(scenarios):
+                        print(f"Completed {len(results)}/{len(scenarios)} scenarios")
+                    if output_file is not None:
+                        writer.writerow(result)
+                        output_file.flush()
+                    if checkpoint_file is not None and key not in completed:
+                        parameters = {name: value for name, value in scenario.items() if name != 'scenario'}
+                        checkpoint_file.write(json.dumps({'key': key, 'parameters': parameters,
+                                                          'metrics': scenario_metrics}) + '\n')
+                        checkpoint_file.flush()
+
+            collect(cached, [completed[key] for _, key in cached])
+
+            if self.n_workers > 1 and len(tasks) > 1:
+                with ProcessPoolExecutor(max_workers=self.n_workers) as executor:
+                    futures = {executor.submit(run_scenarios, task_configs, self.result_store, base_config): members
+                               for task_configs, members in tasks.values()}
+                    for future in as_completed(futures):
+                        collect(futures[future], future.result())
+            else:
+                for task_configs, members in tasks.values():
+                    collect(members, run_scenarios(task_configs, self.result_store, base_config))
+        finally:
+            for f in (output_file, checkpoint_file):
+                if f is not None:
+                    f.close()
+
+        return sorted(results, key=lambda result: result['scenario'])
+
+    def run_flexible_sensitivity_analysis(self, vary_parameters: List[str], output: Optional[str] = None,
+                                          checkpoint: Optional[str] = None) -> pd.DataFrame:
+        """
+        Run sensitivity analysis for specified parameters only
+
+        Args:
+            vary_parameters: List of parameter names to vary (e.g., ['prevalence', 'treatment_access'])
+            output: CSV file that each scenario's results are written to as soon as they complete
+            checkpoint: JSON lines file of completed scenarios; scenarios found in it are not run again,
+                        and scenarios completed by this run are added to it
+        """
+        scenarios = self.define_scenarios(vary_parameters)
+        param_names = [param for param in vary_parameters if f'{param}_label' in scenarios[0]]
+
+        print(f"Running {len(scenarios)} scenarios for parameters: {vary_parameters}")
+        print(f"Total combinations: {' × '.join([f'{len(self.define_parameter_ranges()[p])} {p}' for p in param_names])}")
+
+        configs = [self.create_config_variant(**{param: scenario[f'{param}_value'] for param in param_names})
+                   for scenario in scenarios]
+        describe = lambda scenario: ", ".join(f"{scenario[f'{param}_label']} {param}" for param in param_names)
+        # DLES and YLSS changes are paired with the base case, when the ranges have one
+        param_ranges = self.define_parameter_ranges()
+        base_config = None
+        if all('base' in param_ranges[param] for param in param_names):
+            base_config = self.create_config_variant(**{param: param_ranges[param]['base'] for param in param_names})
+        results = self.evaluate(scenarios, configs, output=output, checkpoint=checkpoint, describe=describe,
+                                base_config=base_config)
+
+        self.results.extend(results)
+
+        # Convert to DataFrame and calculate percentage changes
+        df = pd.DataFrame(self.results)
+
+        base_case = df[df['is_base_case']]
+        if len(base_case):
+            base_case_dles = base_case['dles'].iloc[0]
+            df['dles_pct_change'] = ((df['dles'] - base_case_dles) / base_case_dles) * 100
+
+        return df
+
+    def run_global_sensitivity_analysis(self, parameters: Optional[List[str]] = None, n_samples: int = 64,
+                                        n_bootstrap: int = 1000, confidence: float = 0.95,
+                                        output: Optional[str] = None, checkpoint: Optional[str] = None) -> pd.DataFrame:
+        """
+        Variance-based global sensitivity analysis over the continuous ranges
+        of define_global_ranges. A scrambled Sobol sequence gives the sample
+        matrices A and B (n_samples rows, rounded up to a power of 2), and each
+        parameter i the matrix AB_i, so (k + 2) * n_samples scenarios are
+        evaluated. Rows that differ only in population or intensity scale
+        parameters share a run (see evaluate), and every row uses the seed of
+        the base case, so simulation noise largely cancels in the differences
+        the indices are estimated from.
+
+        Returns the first-order (S1) and total (ST) Sobol indices of DLES and
+        YLSS for each parameter, with bootstrap confidence intervals.
+        """
+        from scipy.stats import qmc
+
+        ranges = self.define_global_ranges()
+        names = list(parameters) if parameters else list(ranges)
+        unknown = [name for name in names if name not in ranges]
+        if unknown:
+            raise ValueError(f"Unknown parameters {unknown}. Available: {list(ranges.keys())}")
+        k = len(names)
+        low, high = np.array([ranges[name] for name in names]).T
+
+        sample = qmc.Sobol(2 * k, scramble=True, seed=self.seed).random_base2(int(np.ceil(np.log2(n_samples))))
+        n = len(sample)
+        a = qmc.scale(sample[:, :k], low, high)
+        b = qmc.scale(sample[:, k:], low, high)
+        matrices = [('A', a), ('B', b)]
+        for i, name in enumerate(names):
+            ab = a.copy()
+            ab[:, i] = b[:, i]
+            matrices.append((f'AB_{name}', ab))
+
+        print(f"Running {len(matrices) * n} scenarios ({n} samples) for parameters: {names}")
+
+        seed = self.create_config_variant().seed
+        scenarios = []
+        configs = []
+        for matrix, values in matrices:
+            for j, row in enumerate(values):
+                scenario = {'scenario': len(scenarios) + 1, 'matrix': matrix, 'sample': j}
+                scenario.update({name: float(value) for name, value in zip(names, row)})
+                config = self.create_config_variant(**{name: scenario[name] for name in names})
+                config.seed = seed
+                scenarios.append(scenario)
+                configs.append(config)
+        results = pd.DataFrame(self.evaluate(scenarios, configs, output=output, checkpoint=checkpoint))
+
+        # Outputs shaped (metric, matrix, sample), matrices in the order A, B, AB_1..AB_k
+        outputs = results[SOBOL_METRICS].to_numpy().T.reshape(len(SOBOL_METRICS), k + 2, n)
+        first_order, total = sobol_indices(outputs[:, 0], outputs[:, 1], outputs[:, 2:])
+
+        # Bootstrap over the sample rows, shared by all matrices
+        rows = np.random.default_rng(self.seed).integers(n, size=(n_bootstrap, n))
+        resampled = np.moveaxis(outputs[:, :, rows], 2, 1)
+        first_order_bootstrap, total_bootstrap = sobol_indices(resampled[..., 0, :], resampled[..., 1, :], resampled[..., 2:, :])
+        quantiles = [(1 - confidence) / 2, (1 + confidence) / 2]
+        first_order_ci = np.quantile(first_order_bootstrap, quantiles, axis=1)
+        total_ci = np.quantile(total_bootstrap, quantiles, axis=1)
+
+        return pd.DataFrame([
+            {'metric': metric, 'parameter': name,
+             'S1': first_order[m, i], 'S1_low': first_order_ci[0, m, i], 'S1_high': first_order_ci[1, m, i],
+             'ST': total[m, i], 'ST_low': total_ci[0, m, i], 'ST_high': total_ci[1, m, i]}
+            for m, metric in enumerate(SOBOL_METRICS) for i, name in enumerate(names)
+        ])
+
+    def format_parameter_labels(self, df: pd.DataFrame, vary_parameters: List[str]) -> pd.DataFrame:
+        """Format parameter labels with values and nice names"""
+        df_formatted = df.copy()
+
+        # Format each parameter that was varied
+        for param in vary_parameters:
+            if f'{param}_label' in df.columns:
+                if param == 'prevalence':
+                    df_formatted[f'{param}_formatted'] = df_formatted.apply(
+                        lambda row: f"{int(row[f'{param}_value'])} ({row[f'{param}_label']})", axis=1
+                    )
+                elif param in ['treatment_access', 'chronic_fraction', 'instensity_scale_factor']:
+                    df_formatted[f'{param}_formatted'] = df_formatted.apply(
+                        lambda row: f"{int(row[f'{param}_value'] * 100)}% ({row[f'{param}_label']})", axis=1
+                    )
+
+        return df_formatted
+
+    def create_flexible_detailed_table(self, df: pd.DataFrame, vary_parameters: List[str]) -> pd.DataFrame:
+        """Create detailed results table for flexible parameter sets"""
+
+        # Format the labels
+        df_formatted = self.format_parameter_labels(df, vary_parameters)
+
+        # Create sorting categories for each varied parameter, with levels ordered by value
+        param_ranges = self.define_parameter_ranges()
+        for param in vary_parameters:
+            if f'{param}_label' in df.columns:
+                order = sorted(param_ranges[param], key=param_ranges[param].get)
+                df_formatted[f'{param}_cat'] = pd.Categorical(
+                    df_formatted[f'{param}_label'], categories=order, ordered=True
+                )
+
+        # Sort by all categorical columns
+        sort_columns = [f'{param}_cat' for param in vary_parameters if f'{param}_cat' in df_formatted.columns]
+        df_sorted = df_formatted.sort_values(sort_columns)
+
+        # Create the final table
+        table_data = {}
+
+        # Add columns for each varied parameter
+        for param in vary_parameters:
+            if f'{param}_formatted' in df_sorted.columns:
+                table_data[PARAMETER_NAMES.get(param, param.title())] = df_sorted[f'{param}_formatted']
+
+        # Add result columns
+        table_data['DLES'] = df_sorted['dles'].apply(lambda x: f"{int(x):,}")
+        table_data['DLES (% change)'] = df_sorted['dles_pct_change'].apply(lambda x: f"{int(x):+d}%")
+        if 'dles_change' in df_sorted.columns:
+            table_data['DLES change (SE)'] = df_sorted.apply(
+                lambda row: f"{int(row['dles_change']):+,} ({int(row['dles_change_se']):,})", axis=1)
+
+        detailed_table = pd.DataFrame(table_data)
+        detailed_table.reset_index(drop=True, inplace=True)
+
+        return detailed_table
+
+    def create_summary_stats(self, df: pd.DataFrame) -> Dict:
+        """Create summary statistics"""
+        base_case = df[df['is_base_case']].iloc[0]
+
+        return {
+            'total_scenarios': len(df),
+            'min_dles': df['dles'].min(),
+            'max_dles': df['dles'].max(),
+            'base_dles': base_case['dles'],
+            'base_ylss': base_case['ylss'],
+            'base_all': base_case['total_person_years'] * 365,  # Convert to days
+            'min_pct_change': df['dles_pct_change'].min(),
+            'max_pct_change': df['dles_pct_change'].max(),
+            'q25_dles': df['dles'].quantile(0.25),
+            'q75_dles': df['dles'].quantile(0.75),
+            'coefficient_variation': (df['dles'].std() / df['dles'].mean()) * 100
+        }
+
+
+def main_flexible(vary_parameters: Optional[List[str]] = None, output_dir: str = './csv', resume: bool = True,
+                  **analyzer_options):
+    """
+    Run flexible sensitivity analysis
+
+    Args:
+        vary_parameters: List of parameters to vary. Options:
+                        ['prevalence', 'treatment_access', 'chronic_fraction', 'instensity_scale_factor']
+                        If None, defaults to the original three parameters
+        output_dir: Directory for the per-scenario results, the detailed table and the checkpoint
+        resume: Reuse scenarios completed by earlier runs (of any grid) from the checkpoint in output_dir
+        analyzer_options: Passed to FlexibleSensitivityAnalyzer (percent_of_patients_to_simulate, seed,
+                          rescale, n_workers, result_store, parameter_ranges, common_random_numbers)
+    """
+    if vary_parameters is None:
+        vary_parameters = DEFAULT_PARAMETERS
+
+    analyzer = FlexibleSensitivityAnalyzer(**analyzer_options)
+    os.makedirs(output_dir, exist_ok=True)
+    filename = f"sensitivity_{'_'.join(vary_parameters)}.csv"
+
+    checkpoint = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not resume and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    # Run analysis, streaming each scenario's results to CSV as it completes
+    results_df = analyzer.run_flexible_sensitivity_analysis(
+        vary_parameters, output=os.path.join(output_dir, f"sensitivity_{'_'.join(vary_parameters)}_scenarios.csv"),
+        checkpoint=checkpoint)
+
+    # Calculate summary statistics
+    summary_stats = analyzer.create_summary_stats(results_df)
+
+    # Create detailed table
+    detailed_table = analyzer.create_flexible_detailed_table(results_df, vary_parameters)
+
+    # Print results
+    print("\n" + "="*80)
+    print(f"FLEXIBLE SENSITIVITY ANALYSIS RESULTS")
+    print(f"Varied parameters: {', '.join(vary_parameters)}")
+    print("="*80)
+
+    print(f"\nScenarios tested: {summary_stats['total_scenarios']}")
+    print(f"Base case DLES: {summary_stats['base_dles']:,.0f} days")
+    print(f"Base case DLES: {summary_stats['base_dles']/365:,.0f} years")
+    print(f"Base case YLSS: {summary_stats['base_ylss']:,.0f} days")
+    print(f"Base case YLSS: {summary_stats['base_ylss']/365:,.0f} years")
+    print(f"Base case ALL: {summary_stats['base_all']:,.0f} days")
+    print(f"Base case ALL: {summary_stats['base_all']/365:,.0f} years")
+    print(f"Range: {summary_stats['min_dles']:,.0f} - {summary_stats['max_dles']:,.0f} days")
+    print(f"Percentage change from base: {summary_stats['min_pct_change']:.1f}% to +{summary_stats['max_pct_change']:.1f}%")
+
+    print("\n" + "="*80)
+    print("DETAILED RESULTS")
+    print("="*80)
+    print(detailed_table.to_string(index=False))
+
+    # Save to CSV
+    detailed_table.to_csv(os.path.join(output_dir, filename), index=False)
+    print(f"\nDetailed table saved to: {filename}")
+    return results_df
+
+
+def main_global(parameters: Optional[List[str]] = None, output_dir: str = './csv', resume: bool = True,
+                n_samples: int = 64, n_bootstrap: int = 1000, **analyzer_options):
+    """
+    Run the global (Sobol) sensitivity analysis over the given parameters, all
+    of define_global_ranges by default, saving the evaluated design and the
+    indices to CSV in output_dir. See main_flexible for the other options.
+    """
+    analyzer = FlexibleSensitivityAnalyzer(**analyzer_options)
+    os.makedirs(output_dir, exist_ok=True)
+    checkpoint = os.path.join(output_dir, CHECKPOINT_FILE)
+    if not resume and os.path.exists(checkpoint):
+        os.remove(checkpoint)
+
+    indices = analyzer.run_global_sensitivity_analysis(parameters, n_samples=n_samples, n_bootstrap=n_bootstrap,
+                                                       output=os.path.join(output_dir, 'sobol_design.csv'),
+                                                       checkpoint=checkpoint)
+
+    print("\n" + "="*80)
+    print("GLOBAL SENSITIVITY ANALYSIS (SOBOL INDICES, 95% BOOTSTRAP CI)")
+    print("="*80)
+    for metric, table in indices.groupby('metric', sort=False):
+        print(f"\n{metric.upper()}")
+        print(table.drop(columns='metric').to_string(index=False, float_format=lambda x: f"{x:.3f}"))
+
+    filename = os.path.join(output_dir, 'sobol_indices.csv')
+    indices.to_csv(filename, index=False)
+    print(f"\nSobol indices saved to: {filename}")
+    return indices
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Sensitivity of the cluster headache burden (DLES) to the model parameters")
+    parser.add_argument('parameters', nargs='*', metavar='PARAMETER',
+                        help="Parameters to vary over their low/base/high values (default: "
+                             f"{' '.join(DEFAULT_PARAMETERS)}), or over their ranges with --global (default: all)")
+    parser.add_argument('--workers', type=int, default=os.cpu_count(), help="Processes simulating scenarios in parallel")
+    parser.add_argument('--percent', type=float, default=0.1, help="Percent of patients to simulate per scenario")
+    parser.add_argument('--seed', type=int, default=42, help="Seed the scenario seeds are derived from")
+    parser.add_argument('--simulate', action='store_true',
+                        help="Simulate every scenario instead of rescaling and reweighting a shared run")
+    parser.add_argument('--level', nargs=3, action='append', default=[], metavar=('PARAMETER', 'LABEL', 'VALUE'),
+                        help="Add a level to a parameter's range, e.g. --level prevalence very_high 120")
+    parser.add_argument('--output-dir', default='./csv', help="Directory for the results CSV files and the checkpoint")
+    parser.add_argument('--crn', action='store_true',
+                        help="Common random numbers: every scenario reuses each patient's random streams, and "
+                             "changes from the base case get paired standard errors")
+    parser.add_argument('--restart', action='store_true', help="Discard the checkpoint and run every scenario")
+    parser.add_argument('--global', dest='global_analysis', action='store_true',
+                        help="Compute Sobol indices from a Saltelli design instead of a factorial grid")
+    parser.add_argument('--samples', type=int, default=64, help="Base samples of the Saltelli design (--global)")
+    parser.add_argument('--bootstrap', type=int, default=1000, help="Bootstrap resamples for the confidence intervals (--global)")
+    args = parser.parse_args(argv)
+    # Checked here rather than with choices=, which argparse also applies to the empty default
+    unknown = [param for param in args.parameters if param not in PARAMETER_NAMES and param not in ATTACK_PARAMETER_NAMES]
+    if unknown:
+        parser.error(f"unknown parameters {', '.join(unknown)} (choose from "
+                     f"{', '.join(list(PARAMETER_NAMES) + ATTACK_PARAMETER_NAMES)})")
+
+    parameter_ranges = {}
+    for param, label, value in args.level:
+        if param not in PARAMETER_NAMES:
+            parser.error(f"unknown parameter {param!r}")
+        parameter_ranges.setdefault(param, {})[label] = float(value)
+
+    options = dict(output_dir=args.output_dir, resume=not args.restart, percent_of_patients_to_simulate=args.percent,
+                   seed=args.seed, rescale=not args.simulate, n_workers=args.workers, parameter_ranges=parameter_ranges,
+                   common_random_numbers=args.crn)
+    if args.global_analysis:
+        main_global(args.parameters, n_samples=args.samples, n_bootstrap=args.bootstrap, **options)
+    else:
+        unknown = [param for param in args.parameters if param not in PARAMETER_NAMES]
+        if unknown:
+            parser.error(f"{', '.join(unknown)} can only be varied with --global")
+        main_flexible(args.parameters or DEFAULT_PARAMETERS, **options)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,12 +1,49 @@
+import copy
+import time
+import contextlib
+import dataclasses
 import numpy as np
 from collections import defaultdict
-from models import Patient
-from stats_utils import calculate_adjusted_pain_units, calculate_ms_distribution
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from models import PatientCohort, GroupAccumulator, BurdenIndex
+from stats_utils import (calculate_ms_distribution, transform_intensity, transform_intensity_matrix,
+                         intensity_scale_weights, get_attack_parameters, PatientStreams)
+
+MINUTES_PER_YEAR = 60 * 24 * 365
+
+# Reweighting to another intensity scale factor is rejected below this effective sample fraction of attacks
+MIN_EFFECTIVE_SAMPLE_FRACTION = 0.5
+
+# Global metrics tracked by run_adaptive: name, intensity threshold and person-years unit (DLES and YLSS are in days)
+CONVERGENCE_METRICS = (('dles', 9, 365), ('ylss', 7, 365), ('total_person_years', 0, 1))
+
+def calculate_group_sizes(total_ch_sufferers, prop_episodic, prop_chronic, prop_treated, prop_untreated):
+    # Untruncated number of sufferers per group; works on scalars and broadcast arrays alike
+    return {
+        'Episodic Treated': total_ch_sufferers * prop_episodic * prop_treated,
+        'Episodic Untreated': total_ch_sufferers * prop_episodic * prop_untreated,
+        'Chronic Treated': total_ch_sufferers * prop_chronic * prop_treated,
+        'Chronic Untreated': total_ch_sufferers * prop_chronic * prop_untreated
+    }
+
+def shard_rng(source):
+    # Shards carry a SeedSequence, or PatientStreams with common random numbers
+    return source if isinstance(source, PatientStreams) else np.random.default_rng(source)
+
+def simulate_shard(shard, n_bins, keep_patient_summaries, intensity_scale_factor, attack_params=None,
+                   stratified=False, antithetic=False, tail_share=None):
+    _, is_chronic, is_treated, n_patients, seed_sequence = shard
+    cohort = PatientCohort(is_chronic, is_treated, n_patients, rng=shard_rng(seed_sequence),
+                           intensity_scale_factor=intensity_scale_factor, attack_params=attack_params,
+                           stratified=stratified, antithetic=antithetic, tail_share=tail_share)
+    cohort.generate_year_of_attacks()
+    return GroupAccumulator.from_summary(cohort.calculate_summary(n_bins), keep_patient_summaries, stratified)
 
 class Simulation:
-    def __init__(self, config):
+    def __init__(self, config, rng=None):
         self.config = config
-        self.population = []
+        self.population = defaultdict(list)
         self.results = None
         self.intensities = np.arange(0, 10.1, 0.1)
         self.intensities_transformed = np.array([])
@@ -20,24 +57,286 @@ class Simulation:
         self.adjusted_avg_pain_units = {}
         self.adjusted_pain_units_ms = np.array([])
         self.group_data = []
+        self.accumulators = {}
+        self.burden_index = None
+        self.effective_sample_fractions = None
+        self.convergence_trace = None
         self.total_ch_sufferers = None
         self.ms_data = []
+        # Inputs each derived quantity was last computed from, so unchanged ones are not recomputed
+        self.derived_inputs = {}
+        self.results_version = 0
+        if rng is not None:
+            # Derive the run's root seed from the given generator
+            self.seed_sequence = np.random.SeedSequence(rng.integers(2**63, size=2))
+        else:
+            self.seed_sequence = np.random.SeedSequence(config.seed)
 
     def run(self):
         self.calculate_ch_groups()
-        self.generate_population()
-        self.simulate_year()
-        self.calculate_results()
+        if self.config.streaming or self.config.n_workers > 1:
+            self.run_streaming()
+        else:
+            self.generate_population()
+            self.simulate_year()
+            self.calculate_results()
+
+    def run_streaming(self):
+        # Simulate shard by shard (on a process pool when n_workers > 1), folding each shard
+        # into its group's accumulator and discarding it, so memory does not grow with the
+        # number of simulated patients.
+        shards = self.get_shards()
+        accumulators = {group: self.new_accumulator() for group in self.ch_groups}
+        with self.shard_executor() as executor:
+            for shard, accumulator in zip(shards, self.simulate_shards(shards, executor)):
+                accumulators[shard[0]].merge(accumulator)
+        self.calculate_results(accumulators)
+
+    def run_adaptive(self, target_relative_error=0.01, time_budget=None, initial_percent=0.005, max_percent=1.0, growth=2.0):
+        # Simulate growing batches until DLES, YLSS and total person-years reach target_relative_error or the
+        # time_budget runs out; the result equals a fixed run at the final percent, and the trace is returned
+        self.config = copy.copy(self.config)
+        self.calculate_ch_groups()
+        start = time.perf_counter()
+        # Runs of complete shards per group; a shard left partial by a batch is simulated again in full by the next
+        complete = {group: self.new_accumulator() for group in self.ch_groups}
+        n_complete = dict.fromkeys(self.ch_groups, 0)
+        self.convergence_trace = []
+        percent = initial_percent
+        with self.shard_executor() as executor:
+            while True:
+                batch_start = time.perf_counter()
+                self.config.percent_of_patients_to_simulate = min(percent, max_percent)
+                group_shards = defaultdict(list)
+                for shard in self.get_shards():
+                    group_shards[shard[0]].append(shard)
+                shards = [shard for group in self.ch_groups for shard in group_shards[group][n_complete[group]:]]
+                accumulators = {group: self.new_accumulator().merge(complete[group]) for group in self.ch_groups}
+                for shard, accumulator in zip(shards, self.simulate_shards(shards, executor)):
+                    accumulators[shard[0]].merge(accumulator)
+                    if shard[3] == self.config.shard_size:
+                        complete[shard[0]].merge(accumulator)
+                        n_complete[shard[0]] += 1
+                self.calculate_results(accumulators)
+
+                row = {'percent_of_patients_to_simulate': self.config.percent_of_patients_to_simulate,
+                       'n_patients': sum(accumulator.n_patients for accumulator in accumulators.values()),
+                       'elapsed': time.perf_counter() - start}
+                for metric, threshold, unit in CONVERGENCE_METRICS:
+                    person_years, standard_error = self.person_years_at_least(threshold)
+                    row[metric], row[f'{metric}_se'] = person_years * unit, standard_error * unit
+                # Standard errors need at least two patients in every group
+                row['converged'] = (min(accumulator.n_patients for accumulator in accumulators.values()) >= 2 and
+                                    all(row[f'{metric}_se'] <= target_relative_error * row[metric] for metric, _, _ in CONVERGENCE_METRICS))
+                self.convergence_trace.append(row)
+
+                batch_time = time.perf_counter() - batch_start
+                if row['converged'] or percent >= max_percent:
+                    break
+                if time_budget is not None and row['elapsed'] + batch_time * growth > time_budget:
+                    break
+                percent *= growth
+        return self.convergence_trace
+
+    def new_accumulator(self):
+        return GroupAccumulator(len(self.intensities), self.config.keep_patient_summaries, self.config.stratified_profiles)
+
+    def shard_executor(self):
+        # Process pool for the shards when n_workers > 1, otherwise they run in this process
+        if self.config.n_workers > 1:
+            return ProcessPoolExecutor(max_workers=self.config.n_workers)
+        return contextlib.nullcontext()
+
+    def simulate_shards(self, shards, executor=None):
+        # Accumulators of the shards, in order
+        shard_args = (shards, repeat(len(self.intensities)), repeat(self.config.keep_patient_summaries),
+                      repeat(self.config.intensity_scale_factor), repeat(self.get_attack_parameters()),
+                      repeat(self.config.stratified_profiles), repeat(self.config.antithetic_attacks),
+                      repeat(self.config.importance_tail_share))
+        return (executor.map if executor is not None else map)(simulate_shard, *shard_args)
+
+    def copy(self):
+        """
+        Copy that shares the simulated results, which run() leaves untouched
+        afterwards, but has its own config and transformation-dependent
+        state, so one cached run can back several app sessions.
+        """
+        simulation = copy.copy(self)
+        simulation.config = copy.copy(self.config)
+        simulation.ch_groups = dict(self.ch_groups) if self.ch_groups is not None else None
+        simulation.adjusted_pain_units = dict(self.adjusted_pain_units)
+        simulation.adjusted_avg_pain_units = dict(self.adjusted_avg_pain_units)
+        simulation.derived_inputs = dict(self.derived_inputs)
+        simulation.ms_data = copy.copy(self.ms_data)
+        if self.burden_index is not None:
+            simulation.burden_index = self.burden_index.copy()
+        return simulation
+
+    def rescaled(self, config):
+        """
+        This run's results for the prevalence, chronic share and treated share
+        of `config`, obtained by rescaling the per-capita group results instead
+        of simulating again: the per-patient distribution of each group does
+        not depend on them. The rest of `config` should match this run's.
+        """
+        simulation = self.copy()
+        simulation.config = copy.copy(config)
+        simulation.calculate_ch_groups()
+        simulation.calculate_results(self.accumulators)
+        return simulation
+
+    def reweighted(self, intensity_scale_factor, min_effective_sample_fraction=MIN_EFFECTIVE_SAMPLE_FRACTION):
+        """
+        This run's results for another intensity scale factor without
+        simulating again. The factor only changes the distribution of max pain
+        intensities (durations are drawn given the intensity), so each attack
+        is weighted by the likelihood ratio of its intensity bin, which
+        rescales the minutes at each bin. The effective sample fraction of the
+        weighted attacks of each group is kept in `effective_sample_fractions`;
+        returns None when reweighting takes it below
+        `min_effective_sample_fraction` of this run's for any group, in which
+        case the factor should be simulated instead.
+        """
+        accumulators = {}
+        effective_sample_fractions = {}
+        for group, accumulator in self.accumulators.items():
+            weights = intensity_scale_weights('Treated' in group, self.config.intensity_scale_factor, intensity_scale_factor)
+            if weights is None:
+                return None
+            accumulators[group] = accumulator.reweighted(weights)
+            effective_sample_fractions[group] = accumulators[group].effective_sample_fraction()
+            if effective_sample_fractions[group] < min_effective_sample_fraction * accumulator.effective_sample_fraction():
+                return None
+
+        simulation = self.copy()
+        simulation.config.intensity_scale_factor = intensity_scale_factor
+        simulation.calculate_results(accumulators)
+        simulation.effective_sample_fractions = effective_sample_fractions
+        return simulation
+
+    def adapted(self, config, run=None):
+        """
+        This run's results for `config`, which may differ from this run's
+        config in the population mix (see rescaled) and the intensity scale
+        factor (see reweighted). When reweighting degenerates, `run` (e.g.
+        ResultStore.get_or_run) is called with `config` with reweighting off.
+        """
+        simulation = self
+        if config.intensity_scale_factor != self.config.intensity_scale_factor:
+            simulation = self.reweighted(config.intensity_scale_factor)
+            if simulation is None:
+                config = copy.copy(config)
+                config.reweight_intensity_scale = False
+                return run(config)
+        return simulation.rescaled(config)
+
+    def calculate_intensity_scale_grid(self, intensity_scale_factors, thresholds=(0, 7, 9)):
+        """
+        Global person-years at or above each intensity threshold for a range
+        of intensity scale factors, by reweighting this run's attacks (see
+        reweighted). Returns the person-years and their standard errors, both
+        shaped (len(intensity_scale_factors), len(thresholds)), and the
+        smallest effective sample fraction over the groups for each factor.
+        Factors whose weights degenerate give NaN.
+        """
+        index = np.rint(np.asarray(thresholds) * (len(self.intensities) - 1) / 10).astype(int)
+        person_years = np.zeros((len(intensity_scale_factors), len(index)))
+        variance = np.zeros_like(person_years)
+        effective_sample_fractions = np.ones(len(intensity_scale_factors))
+        for i, intensity_scale_factor in enumerate(intensity_scale_factors):
+            for group, accumulator in self.accumulators.items():
+                weights = intensity_scale_weights('Treated' in group, self.config.intensity_scale_factor, intensity_scale_factor)
+                if weights is None:
+                    person_years[i] = variance[i] = effective_sample_fractions[i] = np.nan
+                    break
+                reweighted = accumulator.reweighted(weights)
+                effective_sample_fractions[i] = min(effective_sample_fractions[i], reweighted.effective_sample_fraction())
+                person_years[i] += self.ch_groups[group] * reweighted.tail_average()[index] / MINUTES_PER_YEAR
+                variance[i] += (self.ch_groups[group] * reweighted.tail_standard_error()[index] / MINUTES_PER_YEAR) ** 2
+        return person_years, np.sqrt(variance), effective_sample_fractions
+
+    def calculate_population_grid(self, annual_prevalence_per_100k, prop_chronic, prop_treated, thresholds=(0, 7, 9)):
+        """
+        Global person-years at or above each intensity threshold for every
+        combination of prevalence, chronic share and treated share (broadcast
+        against each other), by rescaling this run's per-capita group results.
+        Returns the person-years and their standard errors, both shaped
+        broadcast(parameters) + (len(thresholds),).
+        """
+        prevalence, prop_chronic, prop_treated = np.broadcast_arrays(
+            np.asarray(annual_prevalence_per_100k, dtype=float), np.asarray(prop_chronic, dtype=float), np.asarray(prop_treated, dtype=float))
+        total_ch_sufferers = self.config.world_adult_population * prevalence / 100_000
+        group_sizes = calculate_group_sizes(total_ch_sufferers, 1 - prop_chronic, prop_chronic, prop_treated, 1 - prop_treated)
+        index = np.rint(np.asarray(thresholds) * (len(self.intensities) - 1) / 10).astype(int)
+
+        person_years = np.zeros(prevalence.shape + index.shape)
+        variance = np.zeros_like(person_years)
+        # Groups are simulated independently, so their variances add up
+        for group, size in group_sizes.items():
+            accumulator = self.accumulators[group]
+            size = np.floor(size)[..., None]
+            person_years += size * accumulator.tail_average()[index] / MINUTES_PER_YEAR
+            variance += (size * accumulator.tail_standard_error()[index] / MINUTES_PER_YEAR) ** 2
+        return person_years, np.sqrt(variance)
+
+    def person_years_at_least(self, threshold=0):
+        # Global person-years at or above the intensity threshold (0-10 scale; scalar or array), with their standard error
+        index = np.rint(np.asarray(threshold) * (len(self.intensities) - 1) / 10).astype(int)
+        person_years = variance = 0.0
+        for group, accumulator in self.accumulators.items():
+            scale = self.ch_groups[group] / MINUTES_PER_YEAR
+            person_years = person_years + scale * accumulator.tail_average()[index]
+            variance = variance + (scale * accumulator.tail_standard_error()[index]) ** 2
+        return person_years, np.sqrt(variance)
+
+    def patient_key(self):
+        # Runs with the same key simulate the same patients, slot by slot, in each group
+        config = self.config.base_config()
+        if config.common_random_numbers and config.seed is not None:
+            return ('common_random_numbers', config.seed)
+        return config.simulation_hash()
+
+    def paired_difference(self, other, threshold=9):
+        # Person-years at >= threshold here minus in `other` and its standard error, pairing patient slots
+        # when both runs simulate the same patients (see patient_key), else treating the runs as independent
+        index = int(round(threshold)) * (len(self.intensities) - 1) // 10
+        difference = 0.0
+        variance = 0.0
+        paired = self.patient_key() == other.patient_key()
+        for group in self.ch_groups:
+            accumulator, other_accumulator = self.accumulators[group], other.accumulators[group]
+            scale = self.ch_groups[group] / MINUTES_PER_YEAR
+            other_scale = other.ch_groups[group] / MINUTES_PER_YEAR
+            difference += scale * accumulator.tail_average()[index] - other_scale * other_accumulator.tail_average()[index]
+
+            x = accumulator.patient_summaries()[3]
+            y = other_accumulator.patient_summaries()[3]
+            n, other_n = accumulator.n_patients, other_accumulator.n_patients
+            stratified = accumulator.stratified or other_accumulator.stratified
+            if len(x) != n or len(y) != other_n or min(n, other_n) < 2 or stratified:
+                variance += ((scale * accumulator.tail_standard_error()[index]) ** 2 +
+                             (other_scale * other_accumulator.tail_standard_error()[index]) ** 2)
+                continue
+            x, y = x[:, int(round(threshold))].astype(float), y[:, int(round(threshold))].astype(float)
+            variance += scale ** 2 * x.var(ddof=1) / n + other_scale ** 2 * y.var(ddof=1) / other_n
+            if paired:
+                # Cov(mean x, mean y) over the slots simulated in both runs
+                m = min(n, other_n)
+                covariance = np.cov(x[:m], y[:m])[0, 1] if m > 1 else 0.0
+                variance -= 2 * scale * other_scale * m * covariance / (n * other_n)
+        return difference, np.sqrt(max(variance, 0.0))
 
     def calculate_ch_groups(self):
+        inputs = (self.config.world_adult_population, self.config.annual_prevalence_per_100k, self.config.prop_chronic,
+                  self.config.prop_episodic, self.config.prop_treated, self.config.prop_untreated)
+        if self.derived_inputs.get('ch_groups') == inputs:
+            return
         self.total_ch_sufferers = self.config.world_adult_population * self.config.annual_prevalence_per_100k / 100_000
 
-        self.ch_groups = {
-            'Episodic Treated': int(self.total_ch_sufferers * self.config.prop_episodic * self.config.prop_treated),
-            'Episodic Untreated': int(self.total_ch_sufferers * self.config.prop_episodic * self.config.prop_untreated),
-            'Chronic Treated': int(self.total_ch_sufferers * self.config.prop_chronic * self.config.prop_treated),
-            'Chronic Untreated': int(self.total_ch_sufferers * self.config.prop_chronic * self.config.prop_untreated)
-        }
+        group_sizes = calculate_group_sizes(self.total_ch_sufferers, self.config.prop_episodic, self.config.prop_chronic,
+                                            self.config.prop_treated, self.config.prop_untreated)
+        self.ch_groups = {group: int(size) for group, size in group_sizes.items()}
+        self.derived_inputs['ch_groups'] = inputs
 
     def get_total_ch_sufferers(self):
         return int(self.total_ch_sufferers)
@@ -52,20 +351,63 @@ class Simulation:
             group_info.append((group, simulated_count, percentage))
         return total_simulated, group_info
     
-    def generate_population(self):
+    def get_shards(self):
+        # Patients of each group are split into fixed-size shards, each with its own seed sequence
+        # (spawned from the run seed by group and shard index), so that results only depend on
+        # the seed and shard_size, not on how shards are distributed over workers. With common random
+        # numbers every patient slot of a group has its own streams instead (see PatientStreams), so the
+        # same slot draws the same numbers in every run with the same seed.
         fraction = self.config.percent_of_patients_to_simulate / 100
-        for group, total in self.ch_groups.items():
+        shard_size = self.config.shard_size
+        shards = []
+        for group_index, (group, total) in enumerate(self.ch_groups.items()):
             n_patients = int(total * fraction)
             is_chronic = 'Chronic' in group
             is_treated = 'Treated' in group
-            for _ in range(n_patients):
-                self.population.append(Patient(is_chronic, is_treated))
+            if self.config.common_random_numbers:
+                group_key = np.random.SeedSequence(self.seed_sequence.entropy,
+                                                   spawn_key=self.seed_sequence.spawn_key + (group_index,)).generate_state(1, np.uint64)[0]
+            for shard_index, start in enumerate(range(0, n_patients, shard_size)):
+                if self.config.common_random_numbers:
+                    seed_sequence = PatientStreams(group_key, offset=start)
+                else:
+                    seed_sequence = np.random.SeedSequence(self.seed_sequence.entropy,
+                                                           spawn_key=self.seed_sequence.spawn_key + (group_index, shard_index))
+                shards.append((group, is_chronic, is_treated, min(shard_size, n_patients - start), seed_sequence))
+        return shards
+
+    def get_attack_parameters(self):
+        # The fitted attacks-per-day parameters with the config's overrides applied, or None for the fitted ones
+        if not self.config.attack_params:
+            return None
+        return dataclasses.replace(get_attack_parameters(), **self.config.attack_params)
+
+    def generate_population(self):
+        self.population = defaultdict(list)
+        for group, is_chronic, is_treated, n_patients, seed_sequence in self.get_shards():
+            self.population[group].append(PatientCohort(is_chronic, is_treated, n_patients,
+                                                        rng=shard_rng(seed_sequence),
+                                                        intensity_scale_factor=self.config.intensity_scale_factor,
+                                                        attack_params=self.get_attack_parameters(),
+                                                        stratified=self.config.stratified_profiles,
+                                                        antithetic=self.config.antithetic_attacks,
+                                                        tail_share=self.config.importance_tail_share))
 
     def simulate_year(self):
-        for patient in self.population:
-            patient.generate_year_of_attacks()
+        for cohorts in self.population.values():
+            for cohort in cohorts:
+                cohort.generate_year_of_attacks()
+
+    def calculate_results(self, accumulators=None):
+        n_bins = len(self.intensities)
+        if accumulators is None:
+            accumulators = {group: self.new_accumulator() for group in self.ch_groups}
+            for group, cohorts in self.population.items():
+                for cohort in cohorts:
+                    accumulators[group].merge(GroupAccumulator.from_summary(cohort.calculate_summary(n_bins),
+                                                                            self.config.keep_patient_summaries,
+                                                                            self.config.stratified_profiles))
 
-    def calculate_results(self):
         group_data = []
         global_person_years = {}
         global_std_person_years = {}
@@ -73,84 +415,92 @@ class Simulation:
         global_total_attack_durations = defaultdict(list)
         global_average_intensity = defaultdict(list)
 
-        for group_name, condition in [
-            ("Episodic Treated", lambda p: not p.is_chronic and p.is_treated),
-            ("Episodic Untreated", lambda p: not p.is_chronic and not p.is_treated),
-            ("Chronic Treated", lambda p: p.is_chronic and p.is_treated),
-            ("Chronic Untreated", lambda p: p.is_chronic and not p.is_treated)
-        ]:
-            group_patients = [p for p in self.population if condition(p)]
-            total_intensity_minutes = {}
-            intensity_minutes_list = {round(i, 1): [] for i in self.intensities}
-            
-            for patient in group_patients:
-                patient_intensity_minutes = patient.calculate_intensity_minutes()
-                for intensity, minutes in patient_intensity_minutes.items():
-                    rounded_intensity = round(intensity, 1)
-                    total_intensity_minutes[rounded_intensity] = total_intensity_minutes.get(rounded_intensity, 0) + minutes
-                    intensity_minutes_list[rounded_intensity].append(minutes)
-                global_total_attacks[group_name].append(patient.calculate_total_attacks())
-                global_total_attack_durations[group_name].append(patient.calculate_total_duration())
-                global_average_intensity[group_name].append(patient.calculate_average_intensity())
-
-            n_patients = len(group_patients)
-            if n_patients > 0:
-                intensity_minutes_average = [total_intensity_minutes.get(round(i, 1), 0) / n_patients for i in self.intensities]
-                intensity_minutes_std = [np.std(intensity_minutes_list[round(i, 1)]) if intensity_minutes_list[round(i, 1)] else 0 for i in self.intensities]
-                intensity_minutes_total = [total_intensity_minutes.get(round(i, 1), 0) for i in self.intensities]
-            else:
-                intensity_minutes_average = [0 for _ in self.intensities]
-                intensity_minutes_std = [0 for _ in self.intensities]
-                intensity_minutes_total = [0 for _ in self.intensities]
-            
-            group_data.append((group_name, intensity_minutes_average, intensity_minutes_std, intensity_minutes_total, n_patients))
+        for group_name in self.ch_groups.keys():
+            accumulator = accumulators[group_name]
+            intensity_minutes_average = accumulator.average()
+            intensity_minutes_std = accumulator.std()
+            intensity_minutes_total = accumulator.minutes_total
+            (global_total_attacks[group_name],
+             global_total_attack_durations[group_name],
+             global_average_intensity[group_name]) = accumulator.patient_summaries()[:3]
+
+            group_data.append((group_name, intensity_minutes_average, intensity_minutes_std, intensity_minutes_total, accumulator.n_patients))
 
             global_total = self.ch_groups[group_name]
-            global_person_years[group_name] = np.array([(a * global_total) / (60 * 24 * 365) for a in intensity_minutes_average])
-            global_std_person_years[group_name] = np.array([(s * global_total) / (60 * 24 * 365) for s in intensity_minutes_std])
+            global_person_years[group_name] = intensity_minutes_average * global_total / MINUTES_PER_YEAR
+            global_std_person_years[group_name] = intensity_minutes_std * global_total / MINUTES_PER_YEAR
 
+        self.accumulators = accumulators
         self.group_data = group_data
         self.global_person_years = global_person_years
         self.global_std_person_years = global_std_person_years
         self.global_total_attacks = global_total_attacks
         self.global_total_attack_durations = global_total_attack_durations
         self.global_average_intensity = global_average_intensity
+        if self.config.importance_tail_share is not None:
+            self.effective_sample_fractions = {group: accumulators[group].effective_sample_fraction() for group in self.ch_groups}
+        self.results_version += 1
+
+        # Threshold sums of the results, extended with the adjusted units by calculate_adjusted_pain_units
+        self.burden_index = BurdenIndex(self.ch_groups.keys(), n_bins)
+        self.burden_index.add('minutes', {name: average for name, average, _, _, _ in group_data})
+        self.burden_index.add('person_years', global_person_years)
+        self.burden_index.add('person_years_variance', {name: std ** 2 for name, std in global_std_person_years.items()})
 
     def calculate_adjusted_pain_units(self):
-        for group in self.ch_groups.keys():
-            self.adjusted_pain_units[group], self.intensities_transformed = calculate_adjusted_pain_units(
-                self.global_person_years[group],
-                self.intensities,
-                self.config.transformation_method,
-                self.config.power,
-                self.config.max_value,
-                self.config.base,
-                self.config.scaling_factor,
-                self.config.n_taylor
-            )
-            avg_data = next(avg for name, avg, _, _, _ in self.group_data if name == group)
-            self.adjusted_avg_pain_units[group], _ = calculate_adjusted_pain_units(
-                avg_data,
-                self.intensities,
-                self.config.transformation_method,
-                self.config.power,
-                self.config.max_value,
-                self.config.base,
-                self.config.scaling_factor,
-                self.config.n_taylor
-            )
-        self.adjusted_pain_units_ms, self.intensities_transformed = calculate_adjusted_pain_units(
-            self.ms_data['y'],
-            self.intensities,
-            self.config.transformation_method,
-            self.config.power,
-            self.config.max_value,
-            self.config.base,
-            self.config.scaling_factor,
-            self.config.n_taylor
-        )
+        # Each part is recomputed only when the transformation, the results or the MS data it uses changed
+        transformation = self.get_transformation_params()
+        transformation_inputs = tuple(transformation.items())
+        if self.derived_inputs.get('intensities_transformed') != transformation_inputs:
+            self.intensities_transformed = transform_intensity(self.intensities, **transformation)
+            self.derived_inputs['intensities_transformed'] = transformation_inputs
+
+        group_inputs = (transformation_inputs, self.results_version)
+        if self.derived_inputs.get('adjusted_pain_units') != group_inputs:
+            for name, avg_data, _, _, _ in self.group_data:
+                self.adjusted_pain_units[name] = self.global_person_years[name] * self.intensities_transformed
+                self.adjusted_avg_pain_units[name] = avg_data * self.intensities_transformed
+            self.burden_index.add('adjusted_minutes', self.adjusted_avg_pain_units)
+            self.burden_index.add('adjusted_person_years', self.adjusted_pain_units)
+            self.derived_inputs['adjusted_pain_units'] = group_inputs
+
+        ms_inputs = (transformation_inputs, self.derived_inputs.get('ms_data'))
+        if self.derived_inputs.get('adjusted_pain_units_ms') != ms_inputs:
+            self.adjusted_pain_units_ms = np.asarray(self.ms_data['y']) * self.intensities_transformed
+            self.derived_inputs['adjusted_pain_units_ms'] = ms_inputs
+
+    def get_transformation_params(self, **overrides):
+        # The configured intensity transformation as transform_intensity keyword arguments
+        params = {
+            'method': self.config.transformation_method,
+            'power': self.config.power,
+            'max_value': self.config.max_value,
+            'base': self.config.base,
+            'scaling_factor': self.config.scaling_factor,
+            'n_taylor': self.config.n_taylor
+        }
+        params.update(overrides)
+        return params
+
+    def calculate_adjusted_pain_units_sweep(self, param_sets):
+        """
+        Adjusted pain units for many intensity transformations at once, without
+        touching the config. Returns the (n_params, n_bins) transformed
+        intensities, a dict of (n_params, n_bins) adjusted global person-years
+        per group, and the (n_params, n_bins) adjusted MS person-years.
+        """
+        transformed = transform_intensity_matrix(self.intensities, param_sets)
+        groups = list(self.ch_groups.keys())
+        time_amounts = np.array([self.global_person_years[group] for group in groups] + [self.ms_data['y']])
+        adjusted = transformed[:, None, :] * time_amounts[None, :, :]
+        adjusted_pain_units = {group: adjusted[:, i] for i, group in enumerate(groups)}
+        return transformed, adjusted_pain_units, adjusted[:, -1]
 
     def calculate_ms_data(self):
+        inputs = (self.config.ms_mean, self.config.ms_median, self.config.ms_std, self.config.world_adult_population,
+                  self.config.ms_prevalence_per_100k, self.config.ms_fraction_of_year_in_pain)
+        if self.derived_inputs.get('ms_data') == inputs:
+            return
         self.ms_data = defaultdict(list)
         self.ms_data['x'], self.ms_data['y'] = calculate_ms_distribution(
             self.config.ms_mean,
@@ -161,6 +511,7 @@ class Simulation:
         # Need to multiply by 0.1 since otherwise I get the distribution only, but the time is the integral, with bin width 0.1
         # Also need to multiply by the hours spent awake (16/24), since 100% of time in pain should be of time awake
         self.ms_data['y'] = self.ms_data['y'] * total_ms_sufferers * self.config.ms_fraction_of_year_in_pain * (16/24) * 0.1
+        self.derived_inputs['ms_data'] = inputs
 
     def update_transformation_params(self, transformation_method, transformation_display, power, base, scaling_factor, ms_mean, ms_median, ms_std, ms_prevalence_per_100k, ms_fraction_of_year_in_pain):
         self.config.transformation_method = transformation_method
@@ -0,0 +1,87 @@
+import copy
+import threading
+from collections import OrderedDict
+from concurrent.futures import Future
+from simulation import Simulation
+
+
+class SimulationCache:
+    """
+    In-memory LRU cache of completed simulation runs, keyed by
+    SimulationConfig.simulation_hash(). Safe to share between threads (app
+    sessions): a configuration requested while it is still running waits for
+    that run instead of starting another. Callers get their own copy of the
+    cached simulation (see Simulation.copy). Misses are looked up in the
+    on-disk `store` (a ResultStore) before simulating, when one is given.
+    Configs with rescale_population or reweight_intensity_scale share the
+    run of their base config (see SimulationConfig.base_config).
+    """
+    def __init__(self, max_size=16, store=None):
+        self.max_size = max_size
+        self.store = store
+        self.simulations = OrderedDict()
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, config):
+        run_config = config.base_config()
+        key = run_config.simulation_hash()
+        # session_copy runs outside the lock, as adapting a run may get other runs from the cache
+        with self.lock:
+            simulation = self.simulations.get(key)
+            if simulation is not None:
+                self.simulations.move_to_end(key)
+                self.hits += 1
+            else:
+                future = self.pending.get(key)
+                is_owner = future is None
+                if is_owner:
+                    future = self.pending[key] = Future()
+                    self.misses += 1
+                else:
+                    self.hits += 1
+
+        if simulation is not None:
+            return self.session_copy(simulation, config)
+        if not is_owner:
+            return self.session_copy(future.result(), config)
+
+        try:
+            if self.store is not None:
+                simulation = self.store.get_or_run(copy.copy(run_config))
+            else:
+                simulation = Simulation(copy.copy(run_config))
+                simulation.run()
+        except BaseException as e:
+            with self.lock:
+                del self.pending[key]
+            future.set_exception(e)
+            raise
+
+        # Only the accumulated results are used from here on, so the cohorts' per-attack arrays are not kept
+        simulation.population.clear()
+        with self.lock:
+            del self.pending[key]
+            self.simulations[key] = simulation
+            while len(self.simulations) > self.max_size:
+                self.simulations.popitem(last=False)
+                self.evictions += 1
+        future.set_result(simulation)
+        return self.session_copy(simulation, config)
+
+    def session_copy(self, simulation, config):
+        if config.rescale_population or config.reweight_intensity_scale:
+            return simulation.adapted(config, run=self.get)
+        return simulation.copy()
+
+    def stats(self):
+        with self.lock:
+            return {'size': len(self.simulations), 'max_size': self.max_size,
+                    'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions}
+
+    def clear(self):
+        with self.lock:
+            self.simulations.clear()
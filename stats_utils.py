@@ -1,11 +1,185 @@
+import os
+import json
+import zlib
+import hashlib
 import numpy as np
-from scipy.stats import lognorm, gmean, rv_discrete, beta, truncnorm, skewnorm
-from scipy.optimize import minimize
+from scipy.special import ndtr, ndtri, betaincinv
 from dataclasses import dataclass
+from functools import lru_cache
+
+# scipy.stats and scipy.optimize are slow to import and only needed to fit the
+# models or for a few helpers, so they are imported inside the functions using them.
 
 INTENSITY_SCALE_FACTOR = 0.9
+# Max pain intensity bin from which attacks count towards the headline tail metrics (9/10 and above)
+TAIL_INTENSITY_BIN = 90
+
+# Fitted model parameters are persisted here, keyed by a hash of the study data they were fitted to
+FIT_CACHE_DIR = os.environ.get('CH_CACHE_DIR', os.path.join(os.path.expanduser('~'), '.cache', 'cluster_headache'))
+
+def load_or_fit(name, inputs, fit):
+    """
+    Return the parameters fitted by `fit()` to `inputs`, reading them from the
+    on-disk cache when the same inputs were fitted before. The cache is best
+    effort: an unreadable or unwritable cache directory just means refitting.
+    """
+    key = hashlib.sha256(json.dumps([name, inputs], sort_keys=True).encode()).hexdigest()[:16]
+    path = os.path.join(FIT_CACHE_DIR, f"{name}-{key}.json")
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        pass
+
+    params = fit()
+    try:
+        os.makedirs(FIT_CACHE_DIR, exist_ok=True)
+        # Write to a private temporary file and rename it, so concurrent workers never read a partial file
+        tmp_path = f"{path}.{os.getpid()}.tmp"
+        with open(tmp_path, 'w') as f:
+            json.dump(params, f)
+        os.replace(tmp_path, path)
+    except OSError:
+        pass
+    return params
+
+def geometric_mean(values):
+    return np.exp(np.mean(np.log(values)))
+
+def mix64(x):
+    # SplitMix64 finalizer on a uint64 array, in place
+    x ^= x >> np.uint64(30)
+    x *= np.uint64(0xBF58476D1CE4E5B9)
+    x ^= x >> np.uint64(27)
+    x *= np.uint64(0x94D049BB133111EB)
+    x ^= x >> np.uint64(31)
+    return x
+
+class UniformStreams:
+    """
+    Base of the random sources that stand in for a numpy Generator in the
+    samplers (random, lognormal and beta) and derive every value from one
+    uniform by inverse CDF, so that the structure of the uniforms (common
+    random numbers, strata, antithetic pairs) carries over to the values.
+    """
+    def lognormal(self, mean=0.0, sigma=1.0, size=None):
+        return np.exp(mean + sigma * ndtri(self.random(size)))
+
+    def beta(self, a, b, size=None):
+        probabilities, quantiles = get_beta_quantile_table(a, b)
+        return np.interp(self.random(size), probabilities, quantiles)
+
+class PatientStreams(UniformStreams):
+    """
+    Counter-based random streams for common random numbers. Each value is a
+    hash of the stream key (seed and group), the patient slot owning it, the
+    quantity drawn and its rank among that patient's values of the quantity,
+    so a patient slot gets the same numbers whatever the other patients, the
+    shard layout or the model parameters of the run. Values move
+    monotonically with the parameters, as they are drawn by inverse CDF.
+    select() gives the owner and rank of each value of the next draws.
+    """
+    def __init__(self, key, offset=0):
+        self.key = int(key)
+        self.offset = offset
+        self.owners = None
+        self.ranks = None
+        self.quantity = 0
+        self.draws = 0
+
+    def select(self, quantity, owners, ranks=None):
+        # Streams for values owned by the cohort's patients `owners`, numbered by `ranks` (0 by default)
+        streams = PatientStreams(self.key, self.offset)
+        streams.quantity = zlib.crc32(quantity.encode())
+        streams.owners = np.asarray(owners, dtype=np.uint64) + np.uint64(self.offset)
+        streams.ranks = np.zeros(len(owners), dtype=np.uint64) if ranks is None else np.asarray(ranks, dtype=np.uint64)
+        return streams
+
+    def random(self, size=None):
+        if size is not None and np.prod(size) != len(self.owners):
+            raise ValueError(f"{size} values requested from streams selected for {len(self.owners)}")
+        # Successive draws of the same selection (e.g. lognormal then beta) use separate streams
+        stream_key = mix64(np.array([self.key ^ (self.quantity << 32) ^ self.draws], dtype=np.uint64))
+        self.draws += 1
+        x = mix64(self.owners ^ stream_key)
+        x += self.ranks * np.uint64(0x9E3779B97F4A7C15)
+        x = mix64(x)
+        return ((x >> np.uint64(11)) + 0.5) * 2.0 ** -53
+
+class StratifiedUniforms(UniformStreams):
+    """
+    Stratified uniforms from `rng`: each draw of n values puts value i in
+    stratum i of the n equal strata of [0, 1), so results follow stratum
+    order.
+    """
+    def __init__(self, rng):
+        self.rng = rng if rng is not None else np.random
 
-def generate_bouts_per_year():
+    def random(self, size=None):
+        n = int(np.prod(size)) if size is not None else 1
+        u = (np.arange(n) + self.rng.random(n)) / n
+        return u.reshape(size) if size is not None else u[0]
+
+class AntitheticUniforms(UniformStreams):
+    """
+    Uniforms from `rng` in antithetic pairs: where `paired` is set, value i
+    is 1 minus value i - 1 (whose own entry must not be set).
+    """
+    def __init__(self, rng, paired):
+        self.rng = rng if rng is not None else np.random
+        self.partners = np.flatnonzero(paired)
+
+    def random(self, size=None):
+        u = self.rng.random(size)
+        u[self.partners] = 1 - u[self.partners - 1]
+        return u
+
+@lru_cache(maxsize=None)
+def get_beta_quantile_table(a, b):
+    # Beta(a, b) quantiles on probabilities dense in both tails; interpolating them is within 1e-6 of
+    # betaincinv and an order of magnitude faster
+    probabilities = ndtr(np.linspace(-8.3, 8.3, 4097))
+    return probabilities, betaincinv(a, b, probabilities)
+
+class AliasTable:
+    """
+    Walker/Vose alias table for O(1) sampling from a fixed discrete
+    distribution, using a single uniform draw per sample.
+    """
+    def __init__(self, values, probabilities):
+        self.values = np.asarray(values)
+        probabilities = np.asarray(probabilities, dtype=float)
+        self.cdf = np.cumsum(probabilities) / probabilities.sum()
+        n = len(probabilities)
+        scaled = probabilities / probabilities.sum() * n
+        self.threshold = np.ones(n)
+        self.alias = np.arange(n)
+        small = [i for i in range(n) if scaled[i] < 1]
+        large = [i for i in range(n) if scaled[i] >= 1]
+        while small and large:
+            i, j = small.pop(), large.pop()
+            self.threshold[i] = scaled[i]
+            self.alias[i] = j
+            scaled[j] -= 1 - scaled[i]
+            (small if scaled[j] < 1 else large).append(j)
+        # Entries left over from round-off keep threshold 1
+
+    def sample(self, size, rng=None):
+        if isinstance(rng, UniformStreams):
+            # Inverse CDF, so that a change of probabilities moves as few common random draws as possible
+            index = np.searchsorted(self.cdf, rng.random(size), side='right')
+            return self.values[np.minimum(index, len(self.cdf) - 1)]
+        u = rng.random(size) if rng is not None else np.random.random_sample(size)
+        u *= len(self.threshold)
+        index = np.minimum(u.astype(np.intp), len(self.threshold) - 1)
+        u -= index
+        return self.values[np.where(u < self.threshold[index], index, self.alias[index])]
+
+# Distribution registry: the pooled study tables and fitted distributions below are
+# built once per parameter set and cached, so samplers only pay for the draws.
+
+@lru_cache(maxsize=None)
+def get_bouts_per_year_table():
     bout_frequency_datapoints = {
         'Gaul': {'n': 209, 'dist': {1: 0.6, 2: 0.3, 3: 0.1}},
         'Li': {'n': 327, 'dist': {0.5: 0.416, 1: 0.370, 2.5: 0.214}},
@@ -27,9 +201,17 @@ def generate_bouts_per_year():
     total_prob = sum(combined_dist.values())
     combined_dist = {k: v/total_prob for k, v in combined_dist.items()}
 
-    return rv_discrete(values=(list(combined_dist.keys()), list(combined_dist.values())))
+    return list(combined_dist.keys()), list(combined_dist.values())
+
+@lru_cache(maxsize=None)
+def get_bouts_per_year_sampler():
+    return AliasTable(*get_bouts_per_year_table())
+
+def sample_bouts_per_year(size, rng=None):
+    return get_bouts_per_year_sampler().sample(size, rng)
 
-def generate_bout_duration_distribution():
+def get_bout_duration_datapoints():
+    # Returns the pooled bout durations (weeks) and study sample sizes
     bout_duration_datapoints = []
     sample_sizes = []
 
@@ -42,24 +224,24 @@ def generate_bout_duration_distribution():
     original_proportions = np.array([0.104, 0.235, 0.502, 0.131])
     sum_proportions = np.sum(original_proportions)
     new_proportions = original_proportions / sum_proportions
-    bout_duration_datapoints.extend([1, gmean([2, 4]), gmean([4, 8]), 8])
+    bout_duration_datapoints.extend([1, geometric_mean([2, 4]), geometric_mean([4, 8]), 8])
     sample_sizes.extend([int(prop * total_li) for prop in new_proportions])
 
     # Friedman & Mikropoulos (1958)
-    bout_duration_datapoints.append(gmean([6, 8]))
+    bout_duration_datapoints.append(geometric_mean([6, 8]))
     sample_sizes.append(50)
 
     # Ekbom (1970)
-    bout_duration_datapoints.append(gmean([4, 12]))
+    bout_duration_datapoints.append(geometric_mean([4, 12]))
     sample_sizes.append(105)
 
     # Lance & Anthony (1971)
-    bout_duration_datapoints.append(gmean([2, 12]))
+    bout_duration_datapoints.append(geometric_mean([2, 12]))
     sample_sizes.append(60)
 
     # Sutherland & Eadie (1970)
     total_sutherland = 58
-    bout_duration_datapoints.extend([np.mean([0, 4]), gmean([5, 13]), gmean([14, 26]), gmean([27, 52])])
+    bout_duration_datapoints.extend([np.mean([0, 4]), geometric_mean([5, 13]), geometric_mean([14, 26]), geometric_mean([27, 52])])
     sample_sizes.extend([int(0.23 * total_sutherland), int(0.45 * total_sutherland), 
                          int(0.19 * total_sutherland), int(0.14 * total_sutherland)])
 
@@ -68,9 +250,18 @@ def generate_bout_duration_distribution():
     sample_sizes.append(101)
 
     # Manzoni et al. (1983)
-    bout_duration_datapoints.append(gmean([4, 8]))
+    bout_duration_datapoints.append(geometric_mean([4, 8]))
     sample_sizes.append(161)
 
+    return [float(x) for x in bout_duration_datapoints], sample_sizes
+
+def generate_bout_duration_distribution(bout_duration_datapoints=None, sample_sizes=None):
+    from scipy.stats import lognorm
+    from scipy.optimize import minimize
+
+    if bout_duration_datapoints is None:
+        bout_duration_datapoints, sample_sizes = get_bout_duration_datapoints()
+
     # Convert to numpy arrays
     bout_duration_datapoints = np.array(bout_duration_datapoints)
     sample_sizes = np.array(sample_sizes)
@@ -86,7 +277,13 @@ def generate_bout_duration_distribution():
     result = minimize(neg_log_likelihood, initial_params, method='Nelder-Mead')
     return result.x
 
-optimal_mu, optimal_sigma = generate_bout_duration_distribution()
+@lru_cache(maxsize=None)
+def get_bout_duration_parameters():
+    # Lognormal (mu, sigma) of bout durations in weeks, fitted on first use
+    datapoints, sample_sizes = get_bout_duration_datapoints()
+    fit = lambda: [float(x) for x in generate_bout_duration_distribution(datapoints, sample_sizes)]
+    mu, sigma = load_or_fit('bout_duration', [datapoints, sample_sizes], fit)
+    return mu, sigma
 
 def fit_lognormal(mean, std):
     variance = std**2
@@ -95,6 +292,7 @@ def fit_lognormal(mean, std):
     return mu, sigma
 
 def truncated_lognorm_pdf(x, mu, sigma, upper_bound=np.inf):
+    from scipy.stats import lognorm
     pdf = lognorm.pdf(x, s=sigma, scale=np.exp(mu))
     cdf_upper = lognorm.cdf(upper_bound, s=sigma, scale=np.exp(mu))
     return np.where(x <= upper_bound, pdf / cdf_upper, 0)
@@ -138,10 +336,36 @@ def initialize_attack_parameters():
         chronic_untreated_mu, chronic_untreated_sigma
     )
 
-# Initialize the parameters
-attack_params = initialize_attack_parameters()
-
-def generate_attacks_per_day(is_chronic, is_treated, max_daily_ch=np.inf, size=1):
+@lru_cache(maxsize=None)
+def get_attack_parameters():
+    return initialize_attack_parameters()
+
+def __getattr__(name):
+    # The fitted parameters used to be module constants computed at import; they are
+    # still available under their old names but are now computed on first access
+    if name == 'optimal_mu':
+        return get_bout_duration_parameters()[0]
+    if name == 'optimal_sigma':
+        return get_bout_duration_parameters()[1]
+    if name == 'attack_params':
+        return get_attack_parameters()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def sample_truncated_lognormal(mu, sigma, lower=0, upper=np.inf, size=None, rng=None):
+    """
+    Inverse-CDF sampling from a lognormal truncated to [lower, upper): one
+    uniform per value, mapped between the CDF values at the bounds, so the
+    draw is exactly the truncated distribution without a rejection loop.
+    """
+    cdf_lower = ndtr((np.log(lower) - mu) / sigma) if lower > 0 else 0.0
+    cdf_upper = ndtr((np.log(upper) - mu) / sigma) if np.isfinite(upper) else 1.0
+    u = rng.random(size) if rng is not None else np.random.random_sample(size)
+    u = cdf_lower + u * (cdf_upper - cdf_lower)
+    return np.exp(mu + sigma * ndtri(u))
+
+def generate_attacks_per_day(is_chronic, is_treated, max_daily_ch=np.inf, size=1, rng=None, attack_params=None):
+    if attack_params is None:
+        attack_params = get_attack_parameters()
     if is_chronic:
         if is_treated:
             mu, sigma = attack_params.chronic_treated_mu, attack_params.chronic_treated_sigma
@@ -153,38 +377,36 @@ def generate_attacks_per_day(is_chronic, is_treated, max_daily_ch=np.inf, size=1
         else:
             mu, sigma = attack_params.episodic_untreated_mu, attack_params.episodic_untreated_sigma
     
-    attacks = lognorm.rvs(s=sigma, scale=np.exp(mu), size=size)
-    
-    # Filter out values that exceed max_daily_ch and resample them
-    while np.any(attacks > max_daily_ch):
-        invalid_indices = attacks > max_daily_ch
-        attacks[invalid_indices] = lognorm.rvs(s=sigma, scale=np.exp(mu), size=np.sum(invalid_indices))
+    # Values above max_daily_ch are excluded by sampling the truncated lognormal directly
+    attacks = sample_truncated_lognormal(mu, sigma, upper=max_daily_ch, size=size, rng=rng)
     
     return np.round(attacks).astype(int)
 
-def generate_chronic_active_days():
+def generate_chronic_active_days(rng=None, size=None):
     min_active_days = 1
     max_active_days = 365
-    while True:
-        active_days = int(lognorm.rvs(s=1.0, scale=np.exp(np.log(150))))
-        if min_active_days <= active_days <= max_active_days:
-            return active_days
+    # int(active_days) lies in [min_active_days, max_active_days] exactly when the
+    # lognormal draw lies in [min_active_days, max_active_days + 1)
+    active_days = sample_truncated_lognormal(np.log(150), 1.0, min_active_days, max_active_days + 1, size=size, rng=rng)
+    active_days = np.minimum(active_days.astype(int), max_active_days)
+    return int(active_days) if size is None else active_days
 
-def generate_attack_duration(is_chronic, is_treated, max_intensities, size):
+def generate_attack_duration(is_chronic, is_treated, max_intensities, size, rng=None):
     mu = 4.0 + (0.25 if is_chronic else 0)
     sigma = 0.5
     
-    base_durations = lognorm.rvs(s=sigma, scale=np.exp(mu), size=size)
-    intensity_factor = 0.1064 * max_intensities + 0.5797
-    adjusted_durations = base_durations * intensity_factor
+    # Work in place on the sampled array to keep a single attack-sized temporary
+    random_state = rng if rng is not None else np.random
+    adjusted_durations = random_state.lognormal(mu, sigma, size)
+    adjusted_durations *= 0.1064 * max_intensities + 0.5797
 
     if is_treated:
         max_effect = 0.3
         intensity_normalized = (max_intensities - 1) / 9
         mean_effect = 1 - (max_effect * intensity_normalized)
         a, b = 5, 2
-        treatment_effect = beta.rvs(a, b, size=size) * mean_effect
-        adjusted_durations *= treatment_effect
+        adjusted_durations *= random_state.beta(a, b, size)
+        adjusted_durations *= mean_effect
     
     return np.clip(np.round(adjusted_durations).astype(int), 15, 360)
 
@@ -192,6 +414,9 @@ def weighted_beta_fit(data1, freq1, data2, freq2, weight1=0.5, weight2=0.5):
     """
     Fit a beta distribution to weighted data from two studies.
     """
+    from scipy.stats import beta
+    from scipy.optimize import minimize
+
     combined_data = np.concatenate([
         np.repeat(data1, freq1),
         np.repeat(data2, freq2)
@@ -215,11 +440,9 @@ def weighted_beta_fit(data1, freq1, data2, freq2, weight1=0.5, weight2=0.5):
     
     return result.x
 
-def generate_max_pain_intensity(is_treated, size, weight_study_1=0.5):
-
-    def discretize(values, bins):
-        return np.digitize(values, bins) * 0.1
-    
+@lru_cache(maxsize=None)
+def get_max_pain_intensity_parameters(is_treated, weight_study_1=0.5, intensity_scale_factor=0.9):
+    # Returns the truncated normal (mean, std, a, b) of max pain intensities
     if not is_treated:
         # Data for untreated patients
         data1 = np.array([9.5, 7.5, 5.5, 3.5, 1.5])  # Study 1 (Russell)
@@ -231,38 +454,100 @@ def generate_max_pain_intensity(is_treated, size, weight_study_1=0.5):
         mean1 = np.average(data1, weights=freq1)
         mean2 = np.average(data2, weights=freq2)
         mean_severe = mean1 * weight_study_1 + mean2 * weight_study_2
-        mean_severe = mean_severe * INTENSITY_SCALE_FACTOR
+        mean_severe = mean_severe * intensity_scale_factor
 
         # Calculate weighted standard deviation
         variance1 = np.average((data1 - mean1)**2, weights=freq1)
         variance2 = np.average((data2 - mean2)**2, weights=freq2)
         std_severe = np.sqrt(variance1 * weight_study_1 + variance2 * weight_study_2) * 1
-
-        # Truncation bounds
-        lower, upper = 0, 10
-
-        # Generate samples for severe attacks
-        a_severe, b_severe = (lower - mean_severe) / std_severe, (upper - mean_severe) / std_severe
-        severe_samples = truncnorm.rvs(a_severe, b_severe, loc=mean_severe, scale=std_severe, size=size)
     
     else:
         # Parameters for treated patients (truncated normal distribution, Snoer data)
-        shift = (7.3 * INTENSITY_SCALE_FACTOR) - 7.3
+        shift = (7.3 * intensity_scale_factor) - 7.3
         median_severe = 7.3 + shift
         q1_severe, q3_severe = 5.9 + shift, 8.7 + shift
         mean_severe = median_severe
         std_severe = (q3_severe - q1_severe) / 1.34  # Approximate std from IQR
 
-        # Generate samples for severe attacks
-        lower, upper = 0, 10
-        a_severe, b_severe = (lower - mean_severe) / std_severe, (upper - mean_severe) / std_severe
-        severe_samples = truncnorm.rvs(a_severe, b_severe, loc=mean_severe, scale=std_severe, size=size)
+    # Truncation bounds
+    lower, upper = 0, 10
+    a_severe, b_severe = (lower - mean_severe) / std_severe, (upper - mean_severe) / std_severe
+    return mean_severe, std_severe, a_severe, b_severe
 
-    # Discretize to 0.1 steps
+@lru_cache(maxsize=None)
+def get_max_pain_intensity_bin_probabilities(is_treated, weight_study_1=0.5, intensity_scale_factor=0.9):
+    mean_severe, std_severe, a_severe, b_severe = get_max_pain_intensity_parameters(is_treated, weight_study_1, intensity_scale_factor)
+    # Intensities are discretized to 0.1 steps with np.digitize, so bin code k holds
+    # the truncated normal mass in [bins[k-1], bins[k])
     bins = np.arange(0, 10.1, 0.1)
-    intensities = discretize(severe_samples, bins)
+    # Truncated normal CDF on [0, 10] from the standard normal CDF
+    cdf_lower, cdf_upper = ndtr(a_severe), ndtr(b_severe)
+    cdf = np.clip((ndtr((bins - mean_severe) / std_severe) - cdf_lower) / (cdf_upper - cdf_lower), 0, 1)
+    return np.diff(cdf, prepend=0)
+
+@lru_cache(maxsize=None)
+def get_max_pain_intensity_importance_weights(is_treated, tail_share, weight_study_1=0.5, intensity_scale_factor=0.9):
+    """
+    Importance sampling distribution of the max pain intensity bins that puts
+    `tail_share` of the attacks at TAIL_INTENSITY_BIN and above, and the
+    likelihood ratios (weights) of the bins against the model's distribution.
+    It is a defensive mixture of the model's distribution and its tail, so
+    every bin stays reachable and the weights are bounded. A tail_share no
+    larger than the model's own tail probability leaves it unchanged.
+    """
+    probabilities = get_max_pain_intensity_bin_probabilities(is_treated, weight_study_1, intensity_scale_factor)
+    tail = np.arange(len(probabilities)) >= TAIL_INTENSITY_BIN
+    tail_probability = probabilities[tail].sum()
+    sampling = probabilities
+    if 0 < tail_probability < tail_share:
+        mixture_share = (tail_share - tail_probability) / (1 - tail_probability)
+        sampling = (1 - mixture_share) * probabilities + mixture_share * np.where(tail, probabilities, 0) / tail_probability
+    return sampling, np.divide(probabilities, sampling, out=np.zeros_like(probabilities), where=sampling > 0)
+
+@lru_cache(maxsize=None)
+def get_max_pain_intensity_sampler(is_treated, weight_study_1=0.5, intensity_scale_factor=0.9, tail_share=None):
+    if tail_share is None:
+        probabilities = get_max_pain_intensity_bin_probabilities(is_treated, weight_study_1, intensity_scale_factor)
+    else:
+        probabilities, _ = get_max_pain_intensity_importance_weights(is_treated, tail_share, weight_study_1, intensity_scale_factor)
+    return AliasTable(np.arange(len(probabilities), dtype=np.uint8), probabilities)
+
+def generate_max_pain_intensity_bins(is_treated, size, weight_study_1=0.5, rng=None, intensity_scale_factor=None, tail_share=None):
+    """
+    Sample max pain intensities as integer bin codes 0-100, where code k
+    stands for intensity k/10 (the index into the 0.1-step intensity grid).
+    Like the other samplers, draws from `rng` (a numpy Generator) when given
+    and from NumPy's global random state otherwise. The intensity scale
+    factor defaults to INTENSITY_SCALE_FACTOR. With `tail_share`, intensities
+    are drawn from the importance sampling distribution of
+    get_max_pain_intensity_importance_weights, and each attack must be
+    weighted by the weight of its bin.
+    """
+    if intensity_scale_factor is None:
+        intensity_scale_factor = INTENSITY_SCALE_FACTOR
+    sampler = get_max_pain_intensity_sampler(is_treated, weight_study_1, intensity_scale_factor, tail_share)
+    return sampler.sample(size, rng)
 
-    return intensities
+def intensity_scale_weights(is_treated, base_scale_factor, scale_factor, weight_study_1=0.5):
+    """
+    Likelihood ratios, per intensity bin, of max pain intensities under
+    `scale_factor` against `base_scale_factor`. Weighting attacks sampled with
+    the base factor by the ratio of their bin gives expectations under the new
+    factor. Returns None when the new distribution puts mass on bins the base
+    one cannot sample.
+    """
+    base = get_max_pain_intensity_bin_probabilities(is_treated, weight_study_1, base_scale_factor)
+    new = get_max_pain_intensity_bin_probabilities(is_treated, weight_study_1, scale_factor)
+    if np.any((base <= 0) & (new > 0)):
+        return None
+    return np.divide(new, base, out=np.zeros_like(new), where=base > 0)
+
+def effective_sample_fraction(counts, weights):
+    # Kish effective sample size of items weighted by bin, as a fraction of the items
+    total = np.sum(counts)
+    if total == 0:
+        return 1.0
+    return np.sum(counts * weights) ** 2 / np.sum(counts * weights ** 2) / total
 
 def transform_intensity(intensities, method='linear', power=2, max_value=1, base=10, scaling_factor=1.0, n_taylor = 10):
     if method == 'linear':
@@ -280,22 +565,54 @@ def transform_intensity(intensities, method='linear', power=2, max_value=1, base
         return (base**(scaling_factor * intensities) - 1) * (max_value / (base**(scaling_factor * 10) - 1))
     elif method == 'taylor':
         y = taylor_expansion_exp(scaling_factor, base, n_taylor, intensities)
-        return (y - 1) / (y.max() - 1) * max_value
+        return (y - 1) / (y.max(axis=-1, keepdims=True) - 1) * max_value
         
     else:
         raise ValueError("Invalid method.")
 
-def calculate_adjusted_pain_units(time_amounts, intensities, transformation_method, power, max_value, base, scaling_factor, n_taylor):
-    transformed_intensities = transform_intensity(intensities,
-                                                  method=transformation_method,
-                                                  power=power,
-                                                  max_value=max_value,
-                                                  base=base,
-                                                  scaling_factor=scaling_factor,
-                                                  n_taylor=n_taylor)
-    return np.array([y * t for y, t in zip(time_amounts, transformed_intensities)]), transformed_intensities
+TRANSFORMATION_DEFAULTS = {'method': 'linear', 'power': 2, 'max_value': 1, 'base': 10, 'scaling_factor': 1.0, 'n_taylor': 10}
+
+def transform_intensity_matrix(intensities, param_sets):
+    """
+    Batched transform_intensity for parameter sweeps. `param_sets` is a
+    sequence of dicts with transform_intensity keyword arguments (missing
+    keys take its defaults); returns the (len(param_sets), len(intensities))
+    matrix whose rows are the transformed intensities of each set.
+    Parameter sets sharing a method are evaluated together by passing their
+    parameters as column vectors; Taylor sets sharing a base and scaling
+    factor are read off a single all-orders expansion.
+    """
+    param_sets = [{**TRANSFORMATION_DEFAULTS, **params} for params in param_sets]
+    transformed = np.empty((len(param_sets), len(intensities)))
+    batches = {}
+    for i, params in enumerate(param_sets):
+        if params['method'] == 'taylor':
+            key = ('taylor', params['base'], params['scaling_factor'])
+        else:
+            key = (params['method'],)
+        batches.setdefault(key, []).append(i)
+
+    for key, rows in batches.items():
+        column = lambda name: np.array([param_sets[i][name] for i in rows], dtype=float)[:, None]
+        if key[0] == 'taylor':
+            _, base, scaling_factor = key
+            n_taylor = np.array([param_sets[i]['n_taylor'] for i in rows])
+            # Order 1 is constant and normalizes to 0/0, as with transform_intensity
+            with np.errstate(divide='ignore', invalid='ignore'):
+                all_orders = transform_intensity_taylor_all_orders(intensities, scaling_factor, base, n_taylor.max())
+            transformed[rows] = all_orders[n_taylor - 1] * column('max_value')
+        else:
+            transformed[rows] = transform_intensity(intensities,
+                                                    method=key[0],
+                                                    power=column('power'),
+                                                    max_value=column('max_value'),
+                                                    base=column('base'),
+                                                    scaling_factor=column('scaling_factor'))
+    return transformed
 
 def calculate_ms_distribution(ms_mean, ms_median, ms_std):
+    from scipy.stats import skewnorm
+
     # Estimate skewness parameter
     a = -4 * (ms_mean - ms_median) / ms_std
     
@@ -323,9 +640,28 @@ def calculate_ms_distribution(ms_mean, ms_median, ms_std):
 def taylor_expansion_exp(a, b, N, x):
     x = np.asarray(x)
     ln_b = np.log(b)
-    result = np.ones_like(x)
-    term = np.ones_like(x)
+    # a and b may be column vectors, giving one expansion per row
+    result = np.ones(np.broadcast_shapes(np.shape(a * ln_b), x.shape))
+    term = np.ones_like(result)
     for n in range(1, N):
         term *= (a * ln_b * x) / n
         result += term
-    return result
\ No newline at end of file
+    return result
+
+def taylor_expansion_exp_all_orders(a, b, N_max, x):
+    """
+    Partial sums of taylor_expansion_exp for every order in one cumulative
+    pass: row N-1 of the (N_max, len(x)) result equals
+    taylor_expansion_exp(a, b, N, x), for N = 1..N_max.
+    """
+    x = np.asarray(x, dtype=float)
+    ln_b = np.log(b)
+    terms = np.ones((N_max,) + x.shape)
+    terms[1:] = (a * ln_b * x) / np.arange(1, N_max).reshape((-1,) + (1,) * x.ndim)
+    np.cumprod(terms, axis=0, out=terms)
+    return np.cumsum(terms, axis=0, out=terms)
+
+def transform_intensity_taylor_all_orders(intensities, scaling_factor, base, N_max, max_value=1):
+    # The 'taylor' transform_intensity for every n_taylor = 1..N_max, one row per order
+    y = taylor_expansion_exp_all_orders(scaling_factor, base, N_max, intensities)
+    return (y - 1) / (y.max(axis=-1, keepdims=True) - 1) * max_value
@@ -3,6 +3,7 @@ import plotly.express as px
 import pandas as pd
 import numpy as np
 import streamlit as st
+from models import tail_sums
 
 class Visualizer:
     def __init__(self, simulation):
@@ -15,6 +16,7 @@ class Visualizer:
         self.global_std_person_years = self.results['global_std_person_years']
         self.ch_groups = self.results['ch_groups']
         self.ms_data = self.results['ms_data']
+        self.burden_index = simulation.burden_index
         self.color_map = {
             'Episodic Treated': px.colors.qualitative.Plotly[0],
             'Episodic Untreated': px.colors.qualitative.Plotly[1],
@@ -141,8 +143,8 @@ class Visualizer:
 
     def create_total_person_years_plot(self):
         groups = list(self.ch_groups.keys())
-        total_values = [sum(self.global_person_years[name]) for name in groups]
-        total_error = [np.sqrt(sum(std**2)) for std in self.global_std_person_years.values()]
+        total_values = [self.burden_index.at_least('person_years', 0, name) for name in groups]
+        total_error = [np.sqrt(self.burden_index.at_least('person_years_variance', 0, name)) for name in groups]
         
         return self.create_bar_plot(groups,
                                     total_values,
@@ -152,8 +154,8 @@ class Visualizer:
 
     def create_high_intensity_person_years_plot(self):
         groups = list(self.ch_groups.keys())
-        high_intensity_values = [sum(years[90:]) for years in self.global_person_years.values()]
-        high_intensity_error = [np.sqrt(sum(std[90:]**2)) for std in self.global_std_person_years.values()]
+        high_intensity_values = [self.burden_index.at_least('person_years', 9, name) for name in groups]
+        high_intensity_error = [np.sqrt(self.burden_index.at_least('person_years_variance', 9, name)) for name in groups]
         
         return self.create_bar_plot(groups,
                                     high_intensity_values,
@@ -162,17 +164,9 @@ class Visualizer:
                                     'Person-years (intensity ≥9/10)')
 
     def create_comparison_plot(self):
-        total_all_groups = sum(sum(years) for years in self.global_person_years.values())
-        total_all_groups_std = np.sqrt(sum(sum(std**2) for std in self.global_std_person_years.values()))
-
-        intensity_all_groups_7 = sum(sum(years[70:]) for years in self.global_person_years.values())
-        intensity_all_groups_7_std = np.sqrt(sum(sum(std[70:]**2) for std in self.global_std_person_years.values()))        
-
-        intensity_all_groups_9 = sum(sum(years[90:]) for years in self.global_person_years.values())
-        intensity_all_groups_9_std = np.sqrt(sum(sum(std[90:]**2) for std in self.global_std_person_years.values()))
-        
-        bar_values = [total_all_groups, intensity_all_groups_7, intensity_all_groups_9]
-        bar_errors = [total_all_groups_std, intensity_all_groups_7_std, intensity_all_groups_9_std]
+        thresholds = [0, 7, 9]
+        bar_values = self.burden_index.at_least('person_years', thresholds)
+        bar_errors = np.sqrt(self.burden_index.at_least('person_years_variance', thresholds))
         
         fig = go.Figure(data=[
             go.Bar(
@@ -199,6 +193,32 @@ class Visualizer:
 
         return fig
     
+    def create_convergence_plot(self):
+        # Running estimates of an adaptive run (see Simulation.run_adaptive) relative to the final ones
+        trace = pd.DataFrame(self.simulation.convergence_trace)
+        labels = {'dles': 'DLES (≥9/10)', 'ylss': 'YLSS (≥7/10)', 'total_person_years': 'Total person-years'}
+        fig = go.Figure()
+        for metric, label in labels.items():
+            final = trace[metric].iloc[-1]
+            fig.add_trace(go.Scatter(
+                x=trace['n_patients'],
+                y=trace[metric] / final,
+                error_y=dict(type='data', array=trace[f'{metric}_se'] / final, visible=True),
+                mode='lines+markers',
+                name=label
+            ))
+
+        fig.update_layout(
+            title='Convergence of the estimates with the number of simulated individuals (±1σ)',
+            xaxis_title='Simulated individuals',
+            yaxis_title='Estimate relative to the final estimate',
+            template=self.template,
+            xaxis=dict(type='log', tickformat=',.0f', tickfont=dict(color=self.text_color), title_font=dict(color=self.text_color)),
+            yaxis=dict(tickformat='.0%', tickfont=dict(color=self.text_color), title_font=dict(color=self.text_color))
+        )
+
+        return fig
+
     def create_adjusted_pain_units_plot(self):
         adjusted_data = []
         for name in self.results['ch_groups'].keys():
@@ -311,50 +331,19 @@ class Visualizer:
         # Prepare data for 3D plot
         intensities = self.intensities[idx:]
         intensities_transformed = self.intensities_transformed[idx:]
-        z_data_ms = []
-        z_data_cluster = []
-
-        # Store the current configuration
-        original_transformation_method = self.simulation.config.transformation_method
-        original_transformation_display = self.simulation.config.transformation_display
-        original_n_taylor = self.simulation.config.n_taylor
-
-        for n_taylor in n_taylor_values:
-            # Temporarily change the configuration
-            self.simulation.config.transformation_method = 'taylor'
-            self.simulation.config.transformation_display = 'Taylor'
-            self.simulation.config.n_taylor = n_taylor
-
-            # Recalculate adjusted pain units
-            self.simulation.calculate_adjusted_pain_units()
-            
-            adjusted_pain_units_ms = self.simulation.adjusted_pain_units_ms[idx:]
-            z_data_ms.append(adjusted_pain_units_ms)
-            total_ms_burden = sum(adjusted_pain_units_ms)
-            
-            # Calculate the global adjusted pain units for cluster headaches
-            global_person_years_ch_all_adjusted = np.zeros_like(adjusted_pain_units_ms)
-            for group in self.simulation.ch_groups.keys():
-                global_person_years_ch_all_adjusted += self.simulation.adjusted_pain_units[group][idx:]
-            
-            z_data_cluster.append(global_person_years_ch_all_adjusted)
-            total_cluster_burden = sum(global_person_years_ch_all_adjusted)
-
-            if total_cluster_burden > total_ms_burden and n_taylor_crossing == 0:
-                n_taylor_crossing = n_taylor
-                intensities_transformed = self.simulation.intensities_transformed[idx:]
 
-        # Reset the original configuration
-        self.simulation.config.transformation_method = original_transformation_method
-        self.simulation.config.transformation_display = original_transformation_display
-        self.simulation.config.n_taylor = original_n_taylor
+        # Adjusted pain units for every Taylor order in one batched call
+        param_sets = [self.simulation.get_transformation_params(method='taylor', n_taylor=n_taylor)
+                      for n_taylor in n_taylor_values]
+        transformed, adjusted_pain_units, adjusted_pain_units_ms = self.simulation.calculate_adjusted_pain_units_sweep(param_sets)
 
-        # Recalculate with original configuration
-        self.simulation.calculate_adjusted_pain_units()
+        z_data_ms = adjusted_pain_units_ms[:, idx:]
+        z_data_cluster = sum(adjusted_pain_units[group][:, idx:] for group in self.simulation.ch_groups.keys())
 
-        # Convert z_data to a 2D arrays
-        z_data_ms = np.array(z_data_ms)
-        z_data_cluster = np.array(z_data_cluster)
+        crossings = np.flatnonzero(z_data_cluster.sum(axis=1) > z_data_ms.sum(axis=1))
+        if len(crossings):
+            n_taylor_crossing = n_taylor_values[crossings[0]]
+            intensities_transformed = transformed[crossings[0], idx:]
     
         # Create the 3D surface plot for ms
         fig.add_trace(go.Surface(
@@ -486,49 +475,26 @@ class Visualizer:
             return f"{value:,.0f} ({adjusted:,.0f})"
     
         table_data = []
-        total_row = {
-            'Group': 'Total',
-            'Average patient': {key: 0 for key in ['Hours', 'High-intensity hours', 'Adjusted units', 'High-intensity adjusted units']},
-            'Global estimate': {key: 0 for key in ['Person-years', 'High-intensity person-years', 'Adjusted units', 'High-intensity adjusted units']}
-        }
+        index = self.simulation.burden_index
 
-        for group in self.results['ch_groups'].keys():
-            avg_data = next(avg for name, avg, _, _, _ in self.results['group_data'] if name == group)
-            avg_hours = sum(avg_data)/60
-            avg_high_hours = sum(avg_data[90:])/60
-            global_years = sum(self.results['global_person_years'][group])
-            global_high_years = sum(self.results['global_person_years'][group][90:])
-
-            self.simulation.global_person_years[group] = self.results['global_person_years'][group]
-            self.simulation.intensities = self.results['intensities']
-            global_adjusted_units = sum(self.simulation.adjusted_pain_units[group])
-            avg_adjusted_units = sum(self.simulation.adjusted_avg_pain_units[group])/60
-            avg_high_adjusted_units = sum(self.simulation.adjusted_avg_pain_units[group][90:])/60
-            global_high_adjusted_units = sum(self.simulation.adjusted_pain_units[group][90:])
-            
+        # The total row adds up the groups' average patients as well as their global estimates
+        for group in list(self.results['ch_groups'].keys()) + ['Total']:
             row = {
                 'Group': group,
                 'Average patient': {
-                    'Hours': avg_hours,
-                    'High-intensity hours': avg_high_hours,
-                    'Adjusted units': avg_adjusted_units,
-                    'High-intensity adjusted units': avg_high_adjusted_units
+                    'Hours': index.at_least('minutes', 0, group)/60,
+                    'High-intensity hours': index.at_least('minutes', 9, group)/60,
+                    'Adjusted units': index.at_least('adjusted_minutes', 0, group)/60,
+                    'High-intensity adjusted units': index.at_least('adjusted_minutes', 9, group)/60
                 },
                 'Global estimate': {
-                    'Person-years': global_years,
-                    'High-intensity person-years': global_high_years,
-                    'Adjusted units': global_adjusted_units,
-                    'High-intensity adjusted units': global_high_adjusted_units
+                    'Person-years': index.at_least('person_years', 0, group),
+                    'High-intensity person-years': index.at_least('person_years', 9, group),
+                    'Adjusted units': index.at_least('adjusted_person_years', 0, group),
+                    'High-intensity adjusted units': index.at_least('adjusted_person_years', 9, group)
                 }
             }
             table_data.append(row)
-            
-            # Update total row
-            for category in ['Average patient', 'Global estimate']:
-                for key in total_row[category].keys():
-                    total_row[category][key] += row[category][key]
-        
-        table_data.append(total_row)
     
         df_data = [
             {
@@ -782,34 +748,20 @@ class Visualizer:
     def create_burden_ratio_heatmap(self):
         n_taylor_values = range(2, 25)
         pain_thresholds = np.arange(0, 10.1, 0.5)
-        
-        original_transformation_method = self.simulation.config.transformation_method
-        original_transformation_display = self.simulation.config.transformation_display
-        original_n_taylor = self.simulation.config.n_taylor
-        
-        ratio_matrix = np.zeros((len(pain_thresholds), len(n_taylor_values)))
-        original_ratios = np.zeros_like(ratio_matrix)
-        
-        for i, threshold in enumerate(pain_thresholds):
-            idx = int(threshold * 10)
-            
-            for j, n_taylor in enumerate(n_taylor_values):
-                self.simulation.config.transformation_method = 'taylor'
-                self.simulation.config.transformation_display = 'Taylor'
-                self.simulation.config.n_taylor = n_taylor
-                
-                self.simulation.calculate_adjusted_pain_units()
-                
-                ch_burden = sum(sum(group[idx:]) for group in self.simulation.adjusted_pain_units.values())
-                ms_burden = sum(self.simulation.adjusted_pain_units_ms[idx:])
-                
-                if ms_burden > 0:
-                    ratio = ch_burden / ms_burden
-                    original_ratios[i, j] = ratio
-                    ratio_matrix[i, j] = np.log10(ratio) if ratio > 0 else np.nan
-                else:
-                    ratio_matrix[i, j] = np.nan
-                    original_ratios[i, j] = np.nan
+        idx = (pain_thresholds * 10).astype(int)
+
+        param_sets = [self.simulation.get_transformation_params(method='taylor', n_taylor=n_taylor)
+                      for n_taylor in n_taylor_values]
+        _, adjusted_pain_units, adjusted_pain_units_ms = self.simulation.calculate_adjusted_pain_units_sweep(param_sets)
+
+        # Burdens at or above every threshold from reverse cumulative sums over the intensity bins
+        ch_adjusted = sum(adjusted_pain_units.values())
+        ch_burden = tail_sums(ch_adjusted)[:, idx].T
+        ms_burden = tail_sums(adjusted_pain_units_ms)[:, idx].T
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            original_ratios = np.where(ms_burden > 0, ch_burden / ms_burden, np.nan)
+            ratio_matrix = np.where(original_ratios > 0, np.log10(original_ratios), np.nan)
         
         max_abs_val = max(abs(np.nanmin(ratio_matrix)), abs(np.nanmax(ratio_matrix)))
         
@@ -875,10 +827,5 @@ class Visualizer:
             height=600,
             template=self.template
         )
-        
-        self.simulation.config.transformation_method = original_transformation_method
-        self.simulation.config.transformation_display = original_transformation_display
-        self.simulation.config.n_taylor = original_n_taylor
-        self.simulation.calculate_adjusted_pain_units()
-        
+
         return fig
\ No newline at end of file